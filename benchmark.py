@@ -0,0 +1,297 @@
+import numpy as np
+
+# point data of the mirgecom examples, as (name, number of components)
+CASE_FIELDS = {
+    "wave": [("u", 1), ("v", 3)],
+    "autoignition": [("cv_mass", 1), ("cv_energy", 1), ("cv_momentum", 3), ("cv_species_mass", 7),
+                     ("dv_temperature", 1), ("dv_pressure", 1), ("reaction_rates", 7)],
+    }
+
+def synthetic_mesh(ndofs, seed = 0):
+    # dg-style triangle mesh: every cell owns its own three nodes
+    rng = np.random.default_rng(seed)
+    ndofs -= ndofs % 3
+    points = np.zeros((ndofs, 3))
+    points[:, :2] = rng.random((ndofs, 2))
+    connectivity = np.arange(ndofs, dtype = np.int64).reshape(-1, 3)
+    return points, connectivity
+
+def synthetic_fields(fields, ndofs, step, seed = 0, noise = 0.0):
+    # smooth fields that change with the step, optionally with noise below the comparison tolerance
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 2 * np.pi, ndofs)
+    values = {}
+    for i, (name, ncomponents) in enumerate(fields):
+        data = np.sin(x[:, None] * (i + 1) + step * 0.01 + np.arange(ncomponents)) + 2.0
+        if noise:
+            data += noise * rng.standard_normal(data.shape)
+        values[name] = data[:, 0] if ncomponents == 1 else data
+    return values
+
+def _vtu_data_array(name, values, offset, header_dtype):
+    import base64
+
+    # appended base64 data, with the size header encoded separately as mirgecom writes it
+    values = np.ascontiguousarray(values)
+    header = base64.b64encode(np.array([values.nbytes], dtype = header_dtype).tobytes())
+    encoded = header + base64.b64encode(values.tobytes())
+    vtk_type = {"f": "Float", "i": "Int", "u": "UInt"}[values.dtype.kind] + str(8 * values.dtype.itemsize)
+    ncomponents = 1 if values.ndim == 1 else values.shape[1]
+    tag = '<DataArray type="%s" Name="%s" NumberOfComponents="%d" format="appended" offset="%d"/>' % (
+        vtk_type, name, ncomponents, offset)
+    return tag, encoded
+
+def write_vtu(filename, points, connectivity, values):
+    header_dtype = np.uint32
+    header_type = "UInt32"
+    if max([points.nbytes, connectivity.nbytes] + [v.nbytes for v in values.values()]) >= 2**32:
+        header_dtype = np.uint64
+        header_type = "UInt64"
+
+    sections = {"PointData": [], "Points": [], "Cells": []}
+    appended = []
+    offset = 0
+    arrays = [("PointData", name, data) for name, data in values.items()] + [
+        ("Points", "points", points),
+        ("Cells", "connectivity", connectivity.reshape(-1)),
+        ("Cells", "offsets", np.arange(1, len(connectivity) + 1, dtype = np.int64) * connectivity.shape[1]),
+        ("Cells", "types", np.full(len(connectivity), 5, dtype = np.uint8)),
+        ]
+    for section, name, data in arrays:
+        tag, encoded = _vtu_data_array(name, data, offset, header_dtype)
+        sections[section].append(tag)
+        appended.append(encoded)
+        offset += len(encoded)
+
+    with open(filename, "wb") as f:
+        f.write(('<?xml version="1.0"?>\n'
+                 '<VTKFile type="UnstructuredGrid" version="0.1" byte_order="LittleEndian" header_type="%s">\n'
+                 '<UnstructuredGrid>\n'
+                 '<Piece NumberOfPoints="%d" NumberOfCells="%d">\n' % (header_type, len(points), len(connectivity))
+                 ).encode())
+        for section, tags in sections.items():
+            f.write(("<%s>\n" % section + "".join(tag + "\n" for tag in tags) + "</%s>\n" % section).encode())
+        f.write(b'</Piece>\n</UnstructuredGrid>\n<AppendedData encoding="base64">\n_')
+        for encoded in appended:
+            f.write(encoded)
+        f.write(b"\n</AppendedData>\n</VTKFile>\n")
+
+def write_pvtu(filename, pieces, fields):
+    import os
+
+    lines = ['<?xml version="1.0"?>',
+             '<VTKFile type="PUnstructuredGrid" version="0.1" byte_order="LittleEndian">',
+             '<PUnstructuredGrid>', '<PPointData>']
+    lines += ['<PDataArray type="Float64" Name="%s" NumberOfComponents="%d"/>' % field for field in fields]
+    lines += ['</PPointData>', '<PPoints>',
+              '<PDataArray type="Float64" Name="points" NumberOfComponents="3"/>', '</PPoints>',
+              '<PCells>',
+              '<PDataArray type="Int64" Name="connectivity" NumberOfComponents="1"/>',
+              '<PDataArray type="Int64" Name="offsets" NumberOfComponents="1"/>',
+              '<PDataArray type="UInt8" Name="types" NumberOfComponents="1"/>',
+              '</PCells>']
+    lines += ['<Piece Source="%s"/>' % os.path.basename(piece) for piece in pieces]
+    lines += ['</PUnstructuredGrid>', '</VTKFile>']
+    with open(filename, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+def write_xdmf_hdf5(filename, points, connectivity, values):
+    import os
+    import h5py
+
+    # same layout as the pyvisfile xdmf writer: Grid/Group_00000/{Connectivity, Nodes, fields}
+    h5_filename = os.path.splitext(filename)[0] + ".h5"
+    h5_name = os.path.basename(h5_filename)
+    group = "/Grid/Group_00000/"
+    with h5py.File(h5_filename, "w") as f:
+        f[group + "Connectivity"] = connectivity
+        f[group + "Nodes"] = points
+        for name, data in values.items():
+            f[group + name] = data
+
+    def data_item(dimensions, number_type, path, name = None):
+        return ('<DataItem ItemType="Uniform" Dimensions="%s" NumberType="%s" Precision="8" Endian="Little" '
+                'Format="HDF"%s>%s:%s</DataItem>' % (" ".join(str(d) for d in dimensions), number_type,
+                                                    "" if name is None else ' Name="%s"' % name, h5_name, path))
+
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<Xdmf xmlns:xi="http://www.w3.org/2001/XInclude" Version="3.0">', '  <Domain>',
+             '    <Grid Name="Group_00000" GridType="Uniform">',
+             '      <Topology TopologyType="Triangle" NumberOfElements="%d">' % len(connectivity),
+             '        ' + data_item(connectivity.shape, "Int", group + "Connectivity", "Connectivity"),
+             '      </Topology>', '      <Geometry GeometryType="XYZ">',
+             '        ' + data_item(points.shape, "Float", group + "Nodes", "Nodes"),
+             '      </Geometry>']
+    for name, data in values.items():
+        attribute_type = "Scalar" if data.ndim == 1 else "Vector"
+        lines += ['      <Attribute Name="%s" Center="Node" AttributeType="%s">' % (name, attribute_type),
+                  '        ' + data_item(data.shape, "Float", group + name), '      </Attribute>']
+    lines += ['    </Grid>', '  </Domain>', '</Xdmf>']
+    with open(filename, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return h5_filename
+
+def generate_run(directory, case, fields, ndofs, nranks, nsteps, noise = 0.0, seed = 0):
+    import os
+
+    # one step sequence as a mirgecom run writes it, plus serial vtu and xdmf+hdf5 views of each step
+    os.makedirs(directory, exist_ok = True)
+    points, connectivity = synthetic_mesh(ndofs, seed)
+    ndofs = len(points)
+    rank_cells = np.array_split(np.arange(len(connectivity)), nranks)
+
+    for step in range(nsteps):
+        values = synthetic_fields(fields, ndofs, step, seed + 1 + step, noise)
+        prefix = os.path.join(directory, "%s-%06d" % (case, step))
+
+        write_vtu(prefix + ".vtu", points, connectivity, values)
+
+        pieces = []
+        for rank, cells in enumerate(rank_cells):
+            # dg nodes are owned by exactly one cell, so pieces are contiguous node ranges
+            nodes = np.arange(cells[0] * 3, (cells[-1] + 1) * 3) if len(cells) else np.zeros(0, dtype = np.int64)
+            piece = "%s-%03d.vtu" % (prefix, rank)
+            write_vtu(piece, points[nodes], connectivity[cells] - (nodes[0] if len(nodes) else 0),
+                      {name: data[nodes] for name, data in values.items()})
+            pieces.append(piece)
+        write_pvtu(prefix + ".pvtu", pieces, fields)
+
+        write_xdmf_hdf5(prefix + ".xmf", points, connectivity, values)
+
+    return ndofs
+
+def _run_benchmark(function_name, first_file, second_file, options):
+    import contextlib
+    import io
+    import time
+
+    import mirgecompare
+
+    # run in a fresh process, so peak rss belongs to this comparison alone
+    function = getattr(mirgecompare, function_name)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(first_file, second_file, **options)
+    seconds = time.perf_counter() - start
+
+    return seconds, peak_rss(), result.passed, sum(field.count for field in result.fields.values())
+
+def peak_rss():
+    import resource
+    import sys
+
+    # VmHWM belongs to this process alone, while on linux ru_maxrss carries over
+    # the rss of the parent from before the exec of a spawned process
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+def run_benchmark(function_name, first_file, second_file, repeat = 1, **options):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    measurements = []
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context("spawn")) as executor:
+            measurements.append(executor.submit(
+                _run_benchmark, function_name, first_file, second_file, options).result())
+
+    # the fastest repetition, with the largest peak memory
+    seconds = min(m[0] for m in measurements)
+    return seconds, max(m[1] for m in measurements), all(m[2] for m in measurements), measurements[0][3]
+
+def comparison_bytes(filename):
+    import os
+
+    import mirgecompare
+
+    return sum(os.path.getsize(f) for f in mirgecompare.comparison_files(filename))
+
+def run_benchmarks(work_dir, case = "wave", ndofs = 10**6, nfields = None, nranks = 4, nsteps = 1, repeat = 1,
+                   tolerance = 1e-12):
+    import os
+
+    fields = CASE_FIELDS[case] if nfields is None else [("f%d" % i, 1) for i in range(nfields)]
+    first_dir = os.path.join(work_dir, "reference")
+    second_dir = os.path.join(work_dir, "new")
+
+    # the second run differs below tolerance, so every value goes through the full comparison
+    ndofs = generate_run(first_dir, case, fields, ndofs, nranks, nsteps)
+    generate_run(second_dir, case, fields, ndofs, nranks, nsteps, noise = tolerance / 100)
+
+    benchmarks = [
+        ("vtu", "compare_files_vtu", dict(file_type = "vtu")),
+        ("pvtu", "compare_files_vtu", dict(file_type = "pvtu")),
+        ("xmf", "compare_files_xdmf", {}),
+        ("h5", "compare_files_hdf5", {}),
+        ]
+
+    results = []
+    for step in range(nsteps):
+        for extension, function_name, options in benchmarks:
+            name = "%s-%06d.%s" % (case, step, extension)
+            first_file = os.path.join(first_dir, name)
+            second_file = os.path.join(second_dir, name)
+
+            seconds, peak_rss, passed, nvalues = run_benchmark(function_name, first_file, second_file, repeat,
+                                                               tolerance = tolerance, **options)
+            nbytes = comparison_bytes(first_file) + comparison_bytes(second_file)
+            results.append({
+                "format": extension,
+                "function": function_name,
+                "step": step,
+                "passed": passed,
+                "seconds": seconds,
+                "bytes": nbytes,
+                "gb_per_s": nbytes / seconds / 1e9,
+                "dofs": ndofs,
+                "dofs_per_s": ndofs / seconds,
+                "values": nvalues,
+                "values_per_s": nvalues / seconds,
+                "peak_rss_bytes": peak_rss,
+                })
+            print(extension, ":", "%.3f s" % seconds, "%.3f GB/s" % results[-1]["gb_per_s"],
+                  "%.3g DOFs/s" % results[-1]["dofs_per_s"], "peak rss %.1f MiB" % (peak_rss / 2**20))
+
+    return {
+        "config": dict(case = case, ndofs = ndofs, fields = fields, nranks = nranks, nsteps = nsteps,
+                       repeat = repeat, tolerance = tolerance),
+        "results": results,
+        }
+
+# run benchmarks
+if __name__ == "__main__":
+    import argparse
+    import json
+    import platform
+    import tempfile
+
+    parser = argparse.ArgumentParser(description = 'Benchmark mirgecompare on synthetic MIRGE-Com outputs')
+    parser.add_argument('--case', choices = sorted(CASE_FIELDS), default = 'wave',
+                        help = 'fields shaped like the output of wave-eager-mpi.py or autoignition-mpi.py')
+    parser.add_argument('--ndofs', type = int, default = 10**6, help = 'number of nodes per step')
+    parser.add_argument('--nfields', type = int, default = None,
+                        help = 'use this many scalar fields instead of the fields of --case')
+    parser.add_argument('--nranks', type = int, default = 4, help = 'number of pvtu pieces')
+    parser.add_argument('--nsteps', type = int, default = 1, help = 'number of time steps')
+    parser.add_argument('--repeat', type = int, default = 1, help = 'repetitions, the fastest is reported')
+    parser.add_argument('--work-dir', type = str, default = None,
+                        help = 'directory for the generated files (default: a temporary directory)')
+    parser.add_argument('--output', type = str, default = 'benchmark.json', help = 'json results file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        report = run_benchmarks(args.work_dir or temp_dir, args.case, args.ndofs, args.nfields, args.nranks,
+                                args.nsteps, args.repeat)
+
+    report["machine"] = dict(platform = platform.platform(), processor = platform.processor(),
+                             python = platform.python_version(), numpy = np.__version__)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent = 2)
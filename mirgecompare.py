@@ -1,80 +1,1554 @@
-def compare_files_vtu(first_file, second_file, file_type, tolerance = 1e-12):
-    import vtk
+import numpy as np
+
+NONFINITE_POLICIES = ("fail", "equal")
+
+class FieldTolerance():
+    # how close the values of one field have to be: |v1 - v2| <= atol + rtol * |v2|, or at most
+    # ulp representable numbers apart. nan and inf values either never pass ("fail"), or pass
+    # where both files hold the same non-finite value ("equal")
+
+    def __init__(self, atol = 1e-12, rtol = 0.0, ulp = None, nan = "fail", inf = "fail"):
+        if nan not in NONFINITE_POLICIES or inf not in NONFINITE_POLICIES:
+            raise ValueError("Unknown nan/inf policy: %s/%s, expected one of %s" % (nan, inf, NONFINITE_POLICIES))
+        self.atol = float(atol)
+        self.rtol = float(rtol)
+        self.ulp = None if ulp is None else int(ulp)
+        self.nan = nan
+        self.inf = inf
+
+    def matching_nonfinite(self, values1, values2):
+        # non-finite values an "equal" policy lets pass, or None if there are none to look for
+        matching = None
+        if self.nan == "equal":
+            matching = np.isnan(values1) & np.isnan(values2)
+        if self.inf == "equal":
+            same_inf = np.isinf(values1) & (values1 == values2)
+            matching = same_inf if matching is None else matching | same_inf
+        return matching
+
+    def within(self, values1, values2, abs_err, matching = None, native = None):
+        # every check of the policy in one vectorized pass over float64 values, true where a value
+        # is within tolerance. NaNs never compare within the absolute or relative tolerance
+        within = abs_err <= self.atol + self.rtol * np.abs(values2)
+        if self.ulp is not None:
+            # ulp distances are measured in the precision the values were written in,
+            # and a finite value is never a few ulp away from an infinity
+            native1, native2 = native or (values1, values2)
+            within |= (ulp_distance(native1, native2) <= self.ulp) & np.isfinite(values1) & np.isfinite(values2)
+        if matching is not None:
+            within |= matching
+        return within
+
+    def as_dict(self):
+        return {"atol": self.atol, "rtol": self.rtol, "ulp": self.ulp, "nan": self.nan, "inf": self.inf}
+
+def ulp_distance(values1, values2):
+    # number of representable floating point numbers between the values, in their own precision
+    dtype = np.result_type(values1, values2)
+    if not np.issubdtype(dtype, np.floating) or dtype.itemsize not in (2, 4, 8):
+        dtype = np.dtype(np.float64)
+    int_type = np.dtype("i%d" % dtype.itemsize)
+
+    ordered = []
+    for values in (values1, values2):
+        bits = np.ascontiguousarray(values, dtype = dtype).view(int_type)
+        # order the bit patterns like the numbers they encode, with -0 equal to +0
+        ordered.append(np.where(bits < 0, np.iinfo(int_type).min - bits, bits).astype(np.int64))
+
+    # unsigned differences cannot overflow for values of opposite sign
+    ordered1, ordered2 = (values.view(np.uint64) for values in ordered)
+    return np.where(ordered[0] >= ordered[1], ordered1 - ordered2, ordered2 - ordered1)
+
+class TolerancePolicy():
+    # per-field tolerances read from a json spec like
+    #   {"atol": 1e-12, "nan": "equal",
+    #    "fields": {"pressure": {"rtol": 1e-10}, "Y_*": {"atol": 1e-14, "ulp": 4}}}
+    # fields are matched by the first shell-style pattern, and otherwise use the top level keys
+
+    KEYS = ("atol", "rtol", "ulp", "nan", "inf")
+
+    def __init__(self, default = None, fields = None):
+        self.default = dict(default or {})
+        self.fields = dict(fields or {})
+        for spec in [self.default] + list(self.fields.values()):
+            unknown = set(spec) - set(self.KEYS)
+            if unknown:
+                raise ValueError("Unknown tolerance policy keys: %s" % sorted(unknown))
+            FieldTolerance(**spec)
+
+    @staticmethod
+    def read(filename, atol = None):
+        import json
+
+        with open(filename) as f:
+            spec = json.load(f)
+        fields = spec.pop("fields", {})
+        # --tolerance is the absolute tolerance of fields the spec leaves open
+        if atol is not None:
+            spec.setdefault("atol", atol)
+        return TolerancePolicy(spec, fields)
+
+    def for_field(self, name, rtol = 0.0):
+        import fnmatch
+
+        # the relative tolerance of the file type applies unless the policy sets one
+        spec = {"rtol": rtol}
+        spec.update(self.default)
+        for pattern, field_spec in self.fields.items():
+            if fnmatch.fnmatchcase(name, pattern):
+                spec.update(field_spec)
+                break
+        return FieldTolerance(**spec)
+
+    def as_dict(self):
+        return dict(self.default, fields = self.fields)
+
+    def __str__(self):
+        import json
+
+        return json.dumps(self.as_dict())
+
+def accepts_identical(tolerance):
+    # whether identical values always pass, which only holds when no field fails nan or inf values
+    if not isinstance(tolerance, TolerancePolicy):
+        return False
+    specs = [tolerance.default] + list(tolerance.fields.values())
+    return all(dict(tolerance.default, **spec).get(key, "fail") == "equal"
+               for spec in specs for key in ("nan", "inf"))
+
+def field_tolerance(tolerance, name, rtol = 0.0):
+    # tolerance of one field, from an absolute tolerance or a tolerance policy
+    if isinstance(tolerance, TolerancePolicy):
+        return tolerance.for_field(name, rtol)
+    return FieldTolerance(tolerance, rtol)
+
+class FieldErrors():
+    # error norms of one field, accumulated block by block in a single pass
+
+    # values per block of the error kernel, small enough for a block's temporaries to stay in cache
+    BLOCK_SIZE = 2**15
+
+    def __init__(self, name, shape = (), source = None):
+        self.name = name
+        self.shape = tuple(shape)
+        self.source = source
+
+        self.count = 0
+        self.over_tolerance = 0
+
+        self.abs_l1 = 0.0
+        self.abs_l2_squared = 0.0
+        self.abs_linf = 0.0
+        self.max_rel_err = 0.0
+
+        # norms of the reference values, for norm-wise relative errors
+        self.ref_l1 = 0.0
+        self.ref_l2_squared = 0.0
+        self.ref_linf = 0.0
+
+        self.worst_index = None
+
+        # only a strided subset of the values was compared
+        self.sampled = False
+
+    def _update_reference(self, values1, matching = None):
+        magnitude = np.abs(values1)
+        if matching is not None:
+            # non-finite values both files agree on are left out of the norms
+            magnitude[matching] = 0.0
+        self.ref_l1 += float(np.sum(magnitude))
+        self.ref_l2_squared += float(np.dot(magnitude, magnitude))
+        self.ref_linf = max(self.ref_linf, float(np.max(magnitude)))
+        return magnitude
+
+    def update(self, values1, values2, tolerance, rtol = 0.0, offset = 0, nthreads = 1):
+        # values are compared as |v1 - v2| <= tolerance + rtol * |v2|, or by the
+        # field's entry of a tolerance policy
+        from concurrent.futures import ThreadPoolExecutor
+
+        limits = field_tolerance(tolerance, self.name, rtol)
+        values1 = np.asarray(values1).reshape(-1)
+        values2 = np.asarray(values2).reshape(-1)
+
+        # large arrays are split into one contiguous range per thread, merged back in order
+        nthreads = max(1, min(nthreads, values1.size // self.BLOCK_SIZE))
+        if nthreads == 1:
+            self._update_range(values1, values2, limits, offset, 0, values1.size)
+            return
+
+        bounds = [values1.size * i // nthreads for i in range(nthreads + 1)]
+        partials = [FieldErrors(self.name, self.shape, self.source) for _ in range(nthreads)]
+        with ThreadPoolExecutor(max_workers = nthreads) as executor:
+            list(executor.map(lambda i: partials[i]._update_range(values1, values2, limits, offset,
+                                                                  bounds[i], bounds[i + 1]), range(nthreads)))
+        for partial in partials:
+            self.merge(partial)
+
+    def _update_range(self, values1, values2, limits, offset, start, stop):
+        # one sweep over cache-sized blocks, so no temporary is larger than a block
+        for block_start in range(start, stop, self.BLOCK_SIZE):
+            block = slice(block_start, min(block_start + self.BLOCK_SIZE, stop))
+            self._update_block(values1[block], values2[block], limits, offset + block_start)
+
+    def _update_block(self, native1, native2, limits, offset):
+        values1 = native1.astype(np.float64, copy = False)
+        values2 = native2.astype(np.float64, copy = False)
+        if values1.size == 0:
+            return
+
+        self.count += values1.size
+        matching = limits.matching_nonfinite(values1, values2)
+        magnitude = self._update_reference(values1, matching)
+
+        with np.errstate(invalid = "ignore"):
+            abs_err = np.abs(values1 - values2)
+        if matching is not None:
+            # non-finite values both files agree on count as no error at all
+            abs_err[matching] = 0.0
+        self.abs_l1 += float(np.sum(abs_err))
+        self.abs_l2_squared += float(np.dot(abs_err, abs_err))
+
+        worst = int(np.argmax(abs_err))
+        if self.worst_index is None or self._worse(abs_err[worst], self.abs_linf):
+            self.abs_linf = float(abs_err[worst])
+            self.worst_index = offset + worst
+
+        # like the worst absolute error, a NaN relative error is never dropped
+        nonzero = magnitude > 0
+        if np.any(nonzero):
+            with np.errstate(invalid = "ignore"):
+                rel_err = float(np.max(abs_err[nonzero] / magnitude[nonzero]))
+            if self._worse(rel_err, self.max_rel_err):
+                self.max_rel_err = rel_err
+        # errors against a zero or NaN reference value
+        if np.any(~(abs_err[~nonzero] <= 0)) and self._worse(float("inf"), self.max_rel_err):
+            self.max_rel_err = float("inf")
+
+        with np.errstate(invalid = "ignore"):
+            within = limits.within(values1, values2, abs_err, matching, (native1, native2))
+        self.over_tolerance += int(np.count_nonzero(~within))
+
+    @staticmethod
+    def _worse(err, worst_err):
+        # the first NaN is the worst error, like argmax within a block
+        return err > worst_err or (err != err and worst_err == worst_err)
+
+    def update_identical(self, values1, tolerance, rtol = 0.0, offset = 0):
+        # block known to be identical in both files, only the reference norms change.
+        # blocks with nan or inf values are compared as usual, the policy may still fail them
+        limits = field_tolerance(tolerance, self.name, rtol)
+        values1 = np.asarray(values1).reshape(-1)
+        for start in range(0, values1.size, self.BLOCK_SIZE):
+            block = values1[start:start + self.BLOCK_SIZE]
+            if not np.all(np.isfinite(block)):
+                self._update_block(block, block, limits, offset + start)
+                continue
+
+            self.count += block.size
+            self._update_reference(block.astype(np.float64, copy = False))
+            if self.worst_index is None:
+                self.worst_index = offset + start
+
+    def merge(self, other):
+        # combine the errors of the same field from another file or piece
+        if self.worst_index is None or (other.worst_index is not None and self._worse(other.abs_linf, self.abs_linf)):
+            self.abs_linf = other.abs_linf
+            self.worst_index = other.worst_index
+            self.shape = other.shape
+            self.source = other.source
+
+        self.count += other.count
+        self.over_tolerance += other.over_tolerance
+        self.abs_l1 += other.abs_l1
+        self.abs_l2_squared += other.abs_l2_squared
+        if self._worse(other.max_rel_err, self.max_rel_err):
+            self.max_rel_err = other.max_rel_err
+        self.ref_l1 += other.ref_l1
+        self.ref_l2_squared += other.ref_l2_squared
+        self.ref_linf = max(self.ref_linf, other.ref_linf)
+        self.sampled = self.sampled or other.sampled
+
+    @property
+    def passed(self):
+        return self.over_tolerance == 0
+
+    @property
+    def max_abs_err(self):
+        return self.abs_linf
+
+    @staticmethod
+    def _relative(err, ref):
+        if err == 0:
+            return 0.0
+        return err / ref if ref > 0 else float("inf")
+
+    def worst_location(self):
+        if self.worst_index is None:
+            return None
+        if not self.shape:
+            return []
+        return [int(i) for i in np.unravel_index(self.worst_index, self.shape)]
+
+    def as_dict(self):
+        abs_l2 = self.abs_l2_squared ** 0.5
+        return {
+            "name": self.name,
+            "count": self.count,
+            "sampled": self.sampled,
+            "over_tolerance": self.over_tolerance,
+            "abs_l1": self.abs_l1,
+            "abs_l2": abs_l2,
+            "abs_linf": self.abs_linf,
+            "rel_l1": self._relative(self.abs_l1, self.ref_l1),
+            "rel_l2": self._relative(abs_l2, self.ref_l2_squared ** 0.5),
+            "rel_linf": self._relative(self.abs_linf, self.ref_linf),
+            "max_rel_err": self.max_rel_err,
+            "worst_file": self.source,
+            "worst_location": self.worst_location(),
+            }
+
+class ComparisonResult():
+    # per-field errors of a comparison, gathered over all fields instead of
+    # stopping at the first failure
+
+    def __init__(self, first_file, second_file, tolerance):
+        self.first_file = first_file
+        self.second_file = second_file
+        self.tolerance = tolerance
+        self.fields = {}
+        self.failed_pairs = []
+
+        # error growth curve of a time-series comparison, one entry per step
+        self.steps = []
+
+    def add_field(self, name, shape = ()):
+        self.fields[name] = FieldErrors(name, shape, self.second_file)
+        return self.fields[name]
+
+    @property
+    def failed_fields(self):
+        return [name for name, field in self.fields.items() if not field.passed]
+
+    @property
+    def passed(self):
+        return not self.failed_fields and not self.failed_pairs
+
+    @property
+    def errors(self):
+        # per-field (max abs err, max rel err)
+        return {name: (field.max_abs_err, field.max_rel_err) for name, field in self.fields.items()}
+
+    def merge(self, other):
+        import copy
+
+        for name, field in other.fields.items():
+            if name in self.fields:
+                self.fields[name].merge(field)
+            else:
+                self.fields[name] = copy.copy(field)
+        self.failed_pairs.extend(other.failed_pairs)
+        self.steps.extend(other.steps)
+
+    def print_summary(self):
+        for name, field in self.fields.items():
+            print("Array", name, ":", "max abs err", field.max_abs_err, "max rel err", field.max_rel_err,
+                  "over tolerance", field.over_tolerance)
+
+    def as_dict(self):
+        return {
+            "first_file": self.first_file,
+            "second_file": self.second_file,
+            "tolerance": self.tolerance.as_dict() if isinstance(self.tolerance, TolerancePolicy) else self.tolerance,
+            "passed": self.passed,
+            "failed_pairs": [list(pair) for pair in self.failed_pairs],
+            "fields": [field.as_dict() for field in self.fields.values()],
+            "steps": self.steps,
+            }
+
+    def write_report(self, filename):
+        import csv
+        import json
+        import os
+
+        # json report, or one csv row per field
+        if os.path.splitext(filename)[1] == ".csv":
+            rows = [field.as_dict() for field in self.fields.values()]
+            with open(filename, "w", newline = "") as f:
+                writer = csv.DictWriter(f, fieldnames = list(FieldErrors("").as_dict()))
+                writer.writeheader()
+                for row in rows:
+                    row["worst_location"] = " ".join(str(i) for i in row["worst_location"] or [])
+                    writer.writerow(row)
+        else:
+            with open(filename, "w") as f:
+                json.dump(self.as_dict(), f, indent = 2)
+
+class FidelityError(ValueError):
+    # failed comparison, carrying the full result of all compared fields
+
+    def __init__(self, message, result = None):
+        super().__init__(message)
+        self.result = result
+
+PROFILE_ENVIRONMENT = "MIRGECOMPARE_PROFILE"
+
+class Profiler():
+    # wall time, bytes read and process peak memory of every phase, as chrome trace events.
+    # worker processes hand their events to the main process through part files
+
+    def __init__(self, filename, worker = False):
+        import os
+        import threading
+
+        self.filename = filename
+        self.pid = os.getpid()
+        self.worker = worker
+        self.events = []
+        self.lock = threading.Lock()
+
+        # phases open on this thread, and the phases of other threads it works for
+        self.local = threading.local()
+
+        # a forked worker starts without the events and open phases of its parent,
+        # which the parent writes itself
+        os.register_at_fork(after_in_child = self._reset)
+
+    def _reset(self):
+        import threading
+
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @staticmethod
+    def _thread_bytes_read():
+        # bytes read by the calling thread through read calls, where the os reports it
+        try:
+            with open("/proc/thread-self/io") as f:
+                for line in f:
+                    if line.startswith("rchar:"):
+                        return int(line.split()[1])
+        except OSError:
+            return None
+
+    @staticmethod
+    def _peak_rss():
+        import resource
+        import sys
+
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+    def _open_phases(self):
+        if not hasattr(self.local, "phases"):
+            self.local.phases = []
+            self.local.parent_phases = []
+        return self.local.phases
+
+    def phase(self, name, **args):
+        import contextlib
+        import os
+        import threading
+        import time
+
+        @contextlib.contextmanager
+        def timed_phase():
+            # bytes read by helper threads on behalf of the phase are added by attach
+            record = {"helper_bytes": 0}
+            phases = self._open_phases()
+            phases.append(record)
+            bytes_before = self._thread_bytes_read()
+            start = time.time()
+            try:
+                yield
+            finally:
+                duration = time.time() - start
+                bytes_after = self._thread_bytes_read()
+                del phases[[i for i, phase in enumerate(phases) if phase is record][0]]
+                if bytes_before is not None and bytes_after is not None:
+                    with self.lock:
+                        args["bytes_read"] = bytes_after - bytes_before + record["helper_bytes"]
+                # ru_maxrss is the peak of the whole process so far, not of this phase
+                args["process_peak_rss_bytes"] = self._peak_rss()
+
+                event = {"name": name, "ph": "X", "ts": start * 1e6, "dur": duration * 1e6,
+                         "pid": os.getpid(), "tid": threading.get_ident(), "args": args}
+                with self.lock:
+                    self.events.append(event)
+
+        return timed_phase()
+
+    def attach(self, function):
+        import functools
+
+        # function to run on a helper thread, whose reads count towards the phases open here
+        self._open_phases()
+        phases = self.local.parent_phases + self.local.phases
+
+        @functools.wraps(function)
+        def attached(*args, **kwargs):
+            self._open_phases()
+            parent_phases, self.local.parent_phases = self.local.parent_phases, phases
+            bytes_before = self._thread_bytes_read()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                bytes_after = self._thread_bytes_read()
+                self.local.parent_phases = parent_phases
+                if bytes_before is not None and bytes_after is not None:
+                    with self.lock:
+                        for record in phases:
+                            record["helper_bytes"] += bytes_after - bytes_before
+
+        return attached
+
+    def flush_worker(self):
+        import json
+        import os
+
+        # events of a worker process are appended to a part file next to the trace
+        if not self.worker and os.getpid() == self.pid:
+            return
+        with self.lock:
+            events, self.events = self.events, []
+        with open("%s.%d.part" % (self.filename, os.getpid()), "a") as f:
+            for event in events:
+                f.write(json.dumps(event) + "\n")
+
+    def collect(self):
+        import glob
+        import json
+        import os
+
+        # events of this process and of finished worker processes
+        events = list(self.events)
+        for part in glob.glob(glob.escape(self.filename) + ".*.part"):
+            with open(part) as f:
+                events.extend(json.loads(line) for line in f)
+            os.remove(part)
+        return events
+
+    def write(self, events = None):
+        import json
+
+        events = self.collect() if events is None else events
+        with open(self.filename, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    @staticmethod
+    def print_summary(events):
+        # total time per phase, longest first
+        totals = {}
+        for event in events:
+            total = totals.setdefault(event["name"], [0, 0.0, 0])
+            total[0] += 1
+            total[1] += event["dur"] / 1e6
+            total[2] += event["args"].get("bytes_read") or 0
+        for name, (count, seconds, nbytes) in sorted(totals.items(), key = lambda item: -item[1][1]):
+            print("Phase", name, ":", count, "calls", "%.6f s" % seconds, nbytes, "bytes read")
+
+def enable_profiling(filename):
+    import os
+
+    global _profiler
+    _profiler = Profiler(filename)
+
+    # spawned worker processes pick the profiler up when they import this module
+    os.environ[PROFILE_ENVIRONMENT] = filename
+    return _profiler
+
+def profile_phase(name, **args):
+    import contextlib
+
+    # timing context of one phase, a no-op unless profiling is enabled
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.phase(name, **args)
+
+def profile_attach(function):
+    # function for a helper thread, counting its reads towards the open phases of the calling thread
+    if _profiler is None:
+        return function
+    return _profiler.attach(function)
+
+def _profiler_from_environment():
+    import os
+
+    filename = os.environ.get(PROFILE_ENVIRONMENT)
+    return None if filename is None else Profiler(filename, worker = True)
+
+_profiler = _profiler_from_environment()
+
+def array_digest(values):
+    # fast content digest of an array, including its dtype and shape
+    with profile_phase("digest", shape = list(values.shape)):
+        fingerprint = ArrayFingerprint(values.dtype, values.shape)
+        fingerprint.digest.update(memoryview(np.ascontiguousarray(values)).cast("B"))
+        return fingerprint.hexdigest()
+
+def file_digest(filename, block_size = 2**20):
+    import hashlib
+
+    # fast content digest of a whole file, read in a single streaming pass
+    digest = hashlib.blake2b(digest_size = 16)
+    with profile_phase("digest", file = filename), open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def files_identical(first_file, second_file):
+    import os
+
+    if os.path.getsize(first_file) != os.path.getsize(second_file):
+        return False
+    return file_digest(first_file) == file_digest(second_file)
+
+class ArrayFingerprint():
+    # streaming digest and summary statistics of an array, fed block by block
+
+    def __init__(self, dtype, shape, data = None):
+        import hashlib
+
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.data = data
+        self.offset = 0
+
+        self.digest = hashlib.blake2b(digest_size = 16)
+        self.digest.update(str((self.dtype.str, self.shape)).encode())
+
+        self.count = 0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.sum = 0.0
+        self.sum_squares = 0.0
+
+    def update(self, block):
+        block = np.ascontiguousarray(block, dtype = self.dtype)
+        self.digest.update(memoryview(block).cast("B"))
+
+        # optional memory-mapped copy of the data, filled in the same pass
+        if self.data is not None:
+            self.data.reshape(-1)[self.offset:self.offset + block.size] = block.reshape(-1)
+            self.offset += block.size
+
+        if block.size > 0:
+            self.count += block.size
+            self.min = min(self.min, float(np.min(block)))
+            self.max = max(self.max, float(np.max(block)))
+            self.sum += float(np.sum(block, dtype = np.float64))
+            self.sum_squares += float(np.sum(np.square(block, dtype = np.float64)))
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+    def as_dict(self):
+        return {
+            "digest": self.hexdigest(),
+            "dtype": self.dtype.str,
+            "shape": list(self.shape),
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "mean": self.sum / self.count if self.count else None,
+            "norm": self.sum_squares ** 0.5,
+            }
+
+class BaselineCache():
+    # on-disk index of reference file fingerprints, keyed by path, mtime and size,
+    # with optional memory-mapped copies of the reference arrays
+
+    def __init__(self, cache_dir, max_bytes = 2**30, keep_data = False):
+        import os
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.keep_data = keep_data
+        self.index_file = os.path.join(cache_dir, "index.json")
+        self.lock_file = os.path.join(cache_dir, "index.lock")
+
+        os.makedirs(cache_dir, exist_ok = True)
+
+    def _locked(self):
+        import contextlib
+        import fcntl
+
+        # index updates are read-modify-write, concurrent workers and processes sharing
+        # the cache take turns on them and on the data files they delete
+        @contextlib.contextmanager
+        def index_lock():
+            with open(self.lock_file, "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+        return index_lock()
+
+    def _read_index(self):
+        import json
+
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        import json
+        import os
+
+        # write atomically, concurrent workers may update the index
+        tmp_file = self.index_file + ".%d.tmp" % os.getpid()
+        with open(tmp_file, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_file, self.index_file)
+
+    @staticmethod
+    def _key(filename):
+        import hashlib
+        import os
+
+        return hashlib.blake2b(os.path.abspath(filename).encode(), digest_size = 16).hexdigest()
+
+    @staticmethod
+    def _stamp(filename, dependencies = ()):
+        import os
+
+        stamp = []
+        for name in (filename,) + tuple(dependencies):
+            stat = os.stat(name)
+            stamp.append([os.path.abspath(name), stat.st_mtime_ns, stat.st_size])
+        return stamp
+
+    def _data_file(self, filename, array_name):
+        import hashlib
+        import os
+
+        array_key = hashlib.blake2b(array_name.encode(), digest_size = 8).hexdigest()
+        return os.path.join(self.cache_dir, self._key(filename) + "-" + array_key + ".npy")
+
+    def lookup(self, filename, dependencies = ()):
+        # return the cached array fingerprints of an unchanged file, or None
+        import time
+
+        with self._locked():
+            index = self._read_index()
+            entry = index.get(self._key(filename))
+            if entry is None:
+                return None
+            if entry["stamp"] != self._stamp(filename, dependencies):
+                # the reference file changed, its cached data must never be used again
+                self._remove_data_files(index.pop(self._key(filename)))
+                self._write_index(index)
+                return None
+
+            entry["last_used"] = time.time()
+            self._write_index(index)
+            return entry["arrays"]
+
+    def load_array(self, filename, array_name):
+        # memory-mapped cached copy of a reference array, or None if only its fingerprint is cached.
+        # only data files of the current index entry belong to the cached reference
+        import os
+
+        with self._locked():
+            entry = self._read_index().get(self._key(filename))
+            data_file = self._data_file(filename, array_name)
+            if entry is None or data_file not in entry["data_files"] or not os.path.exists(data_file):
+                return None
+            return np.load(data_file, mmap_mode = "r")
+
+    def fingerprint(self, filename, array_name, dtype, shape):
+        data = None
+        if self.keep_data:
+            data = np.lib.format.open_memmap(self._data_file(filename, array_name), mode = "w+",
+                                             dtype = dtype, shape = tuple(shape))
+        return ArrayFingerprint(dtype, shape, data)
+
+    def store(self, filename, fingerprints, dependencies = ()):
+        import time
+
+        nbytes = 0
+        for fingerprint in fingerprints.values():
+            if fingerprint.data is not None:
+                fingerprint.data.flush()
+                nbytes += fingerprint.data.nbytes
+
+        data_files = [self._data_file(filename, name) for name, fingerprint in fingerprints.items()
+                      if fingerprint.data is not None]
+
+        with self._locked():
+            index = self._read_index()
+
+            # data of a replaced entry that the new entry did not just rewrite is out of date
+            replaced = index.get(self._key(filename))
+            if replaced is not None:
+                self._remove_data_files(replaced, keep = data_files)
+
+            index[self._key(filename)] = {
+                "stamp": self._stamp(filename, dependencies),
+                "arrays": {name: fingerprint.as_dict() for name, fingerprint in fingerprints.items()},
+                "data_files": data_files,
+                "nbytes": nbytes,
+                "last_used": time.time(),
+                }
+
+            self._evict(index)
+            self._write_index(index)
+
+    def _evict(self, index):
+        # drop least recently used entries until the cached data fits in max_bytes
+        total_bytes = sum(entry["nbytes"] for entry in index.values())
+        for key in sorted(index, key = lambda key: index[key]["last_used"]):
+            if total_bytes <= self.max_bytes:
+                break
+
+            entry = index.pop(key)
+            total_bytes -= entry["nbytes"]
+            self._remove_data_files(entry)
+
+    @staticmethod
+    def _remove_data_files(entry, keep = ()):
+        import os
+
+        for data_file in entry["data_files"]:
+            if data_file not in keep and os.path.exists(data_file):
+                os.remove(data_file)
+
+VTK_DATA_TYPES = {
+    "Float32": np.float32, "Float64": np.float64,
+    "Int8": np.int8, "Int16": np.int16, "Int32": np.int32, "Int64": np.int64,
+    "UInt8": np.uint8, "UInt16": np.uint16, "UInt32": np.uint32, "UInt64": np.uint64,
+    }
+
+VTK_COMPRESSORS = ("vtkZLibDataCompressor", "vtkLZMADataCompressor")
+
+def vtk_decompressor(compressor):
+    # block decompression function for a vtk compressor class name
+    if compressor == "vtkZLibDataCompressor":
+        import zlib
+        return zlib.decompress
+    elif compressor == "vtkLZMADataCompressor":
+        import lzma
+        return lzma.decompress
+    raise TypeError("Compressed data is not supported")
+
+class VtuReader():
+    # reads the xml header of a .vtu file and decodes its DataArrays one at a time on demand
+
+    def __init__(self, filename, header_block_size = 2**20):
+        import re
+        import xml.etree.ElementTree as ET
+
+        self.filename = filename
+
+        # read up to the appended data section, which is not parsed as xml,
+        # and on to the underscore that starts the appended data
+        header = b""
+        with open(filename, "rb") as f:
+            while b"<AppendedData" not in header:
+                block = f.read(header_block_size)
+                if not block:
+                    break
+                header += block
+
+            appended_start = header.find(b"<AppendedData")
+            if appended_start >= 0:
+                tag_end = header.find(b">", appended_start)
+                while tag_end < 0 or header.find(b"_", tag_end) < 0:
+                    block = f.read(header_block_size)
+                    if not block:
+                        print("File:", filename)
+                        raise ValueError("Appended data section is truncated")
+                    header += block
+                    tag_end = header.find(b">", appended_start)
+
+        if appended_start < 0:
+            root = ET.fromstring(header)
+            self.appended_encoding = None
+            self.appended_offset = None
+        else:
+
+            encoding = re.search(rb'encoding="(\w+)"', header[appended_start:tag_end])
+            self.appended_encoding = encoding.group(1).decode() if encoding else "raw"
+            if self.appended_encoding not in ("raw", "base64"):
+                raise TypeError("Appended data stored in unrecognized encoding")
+
+            # appended offsets count from the byte after the leading underscore
+            self.appended_offset = header.find(b"_", tag_end) + 1
+            root = ET.fromstring(header[:appended_start] + b"</VTKFile>")
+
+        if root.get("type") != "UnstructuredGrid":
+            raise TypeError("File is not an unstructured grid")
+
+        self.byte_order = "<" if root.get("byte_order", "LittleEndian") == "LittleEndian" else ">"
+        self.header_dtype = np.dtype(
+            self.byte_order + ("u8" if root.get("header_type", "UInt32") == "UInt64" else "u4"))
+        self.compressor = root.get("compressor")
+
+        # pieces of one file would have to be concatenated, that is left to vtk
+        pieces = root.findall("UnstructuredGrid/Piece")
+        if len(pieces) != 1:
+            raise TypeError("Files with %d pieces are not supported" % len(pieces))
+        self.piece = pieces[0]
+        self.number_of_points = int(self.piece.get("NumberOfPoints"))
+
+        point_data = self.piece.find("PointData")
+        self.point_data_arrays = [] if point_data is None else point_data.findall("DataArray")
+
+        # mesh arrays, used to match points between differently partitioned grids
+        self.points_array = self.piece.find("Points/DataArray")
+        cells = self.piece.find("Cells")
+        self.cell_arrays = {} if cells is None else {a.get("Name"): a for a in cells.findall("DataArray")}
+
+        # opened on first use by map_appended_array
+        self.mapping = None
+
+        # fail early on anything that cannot be decoded, so callers can fall back to vtk
+        self.decompress = None
+        mesh_arrays = [] if self.points_array is None else [self.points_array]
+        for data_array in self.point_data_arrays + mesh_arrays + list(self.cell_arrays.values()):
+            self.array_dtype(data_array)
+            data_format = data_array.get("format")
+            if data_format not in ("ascii", "binary", "appended"):
+                raise TypeError("Data stored in unrecognized format")
+            if data_format != "ascii" and self.compressor is not None and self.decompress is None:
+                self.decompress = vtk_decompressor(self.compressor)
+
+    def array_dtype(self, data_array):
+        dtype = VTK_DATA_TYPES.get(data_array.get("type"))
+        if dtype is None:
+            raise TypeError("DataArray stored in unrecognized type")
+        return np.dtype(dtype).newbyteorder(self.byte_order)
+
+    def array_shape(self, data_array):
+        ncomponents = int(data_array.get("NumberOfComponents", "1"))
+        if ncomponents == 1:
+            return (self.number_of_points,)
+        return (self.number_of_points, ncomponents)
+
+    def _decode_base64(self, read_chars):
+        import base64
+        import math
+
+        # the size header may be encoded on its own (padded) or together with the data
+        header_size = self.header_dtype.itemsize
+        header_chars = 4 * math.ceil(header_size / 3)
+        encoded_header = read_chars(0, header_chars)
+        nbytes = int(np.frombuffer(base64.b64decode(encoded_header)[:header_size], self.header_dtype)[0])
+
+        if encoded_header.endswith(b"="):
+            return base64.b64decode(read_chars(header_chars, 4 * math.ceil(nbytes / 3)))
+        return base64.b64decode(read_chars(0, 4 * math.ceil((header_size + nbytes) / 3)))[header_size:]
+
+    def _decode_compressed(self, read_chars, base64_encoded):
+        import base64
+        import math
+
+        def read(start, nbytes):
+            # (decoded bytes, position after them) of the stream at a given position
+            if not base64_encoded:
+                return read_chars(start, nbytes), start + nbytes
+            nchars = 4 * math.ceil(nbytes / 3)
+            return base64.b64decode(read_chars(start, nchars))[:nbytes], start + nchars
+
+        # block header [nblocks, block size, last block size, compressed sizes...] is encoded on its own
+        header_size = self.header_dtype.itemsize
+        nblocks = int(np.frombuffer(read(0, 3 * header_size)[0], self.header_dtype)[0])
+        header, position = read(0, (3 + nblocks) * header_size)
+        compressed_sizes = np.frombuffer(header, self.header_dtype)[3:].astype(np.int64)
+
+        data = read(position, int(compressed_sizes.sum()))[0]
+        offsets = np.concatenate(([0], np.cumsum(compressed_sizes)))
+        return b"".join(self.decompress(data[offsets[i]:offsets[i + 1]]) for i in range(nblocks))
+
+    def read_raw_bytes(self, data_array):
+        data_format = data_array.get("format")
+        if data_format == "binary":
+            text = data_array.text.strip().encode()
+
+            def read_chars(start, nchars):
+                return text[start:start + nchars]
+
+            if self.decompress is not None:
+                return self._decode_compressed(read_chars, True)
+            return self._decode_base64(read_chars)
+
+        if data_format != "appended":
+            raise TypeError("Data stored in unrecognized format")
+
+        position = self.appended_offset + int(data_array.get("offset"))
+        with open(self.filename, "rb") as f:
+            def read_chars(start, nchars):
+                f.seek(position + start)
+                return f.read(nchars)
+
+            if self.decompress is not None:
+                return self._decode_compressed(read_chars, self.appended_encoding == "base64")
+            if self.appended_encoding == "base64":
+                return self._decode_base64(read_chars)
+
+            nbytes = int(np.frombuffer(read_chars(0, self.header_dtype.itemsize), self.header_dtype)[0])
+            return f.read(nbytes)
+
+    def map_appended_array(self, data_array):
+        # zero-copy view of uncompressed raw appended data, served from the os page cache
+        import mmap
+
+        if self.mapping is None:
+            with open(self.filename, "rb") as f:
+                self.mapping = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+        position = self.appended_offset + int(data_array.get("offset"))
+        nbytes = int(np.frombuffer(self.mapping, self.header_dtype, 1, position)[0])
+        dtype = self.array_dtype(data_array)
+        return np.frombuffer(self.mapping, dtype, nbytes // dtype.itemsize, position + self.header_dtype.itemsize)
+
+    def read_array(self, data_array, shape = None):
+        with profile_phase("decode vtu array", file = self.filename, array = data_array.get("Name")):
+            return self._read_array(data_array, shape)
+
+    def _read_array(self, data_array, shape = None):
+        if (data_array.get("format") == "appended" and self.appended_encoding == "raw"
+                and self.decompress is None):
+            values = self.map_appended_array(data_array)
+        elif data_array.get("format") == "ascii":
+            values = np.array((data_array.text or "").split(), dtype = self.array_dtype(data_array))
+        else:
+            values = np.frombuffer(self.read_raw_bytes(data_array), self.array_dtype(data_array))
+        values = values.reshape(self.array_shape(data_array) if shape is None else shape)
+
+        # same native byte order as the vtk reader
+        if not values.dtype.isnative:
+            values = values.astype(values.dtype.newbyteorder("="))
+        return values
+
+def open_vtu_pieces(filename, file_type, use_vtk = False):
+    # native readers for the pieces of a .vtu/.pvtu file, or None when vtk has to read it
+    if use_vtk:
+        return None
+
+    try:
+        with profile_phase("parse vtu headers", file = filename):
+            if file_type == "vtu":
+                return [VtuReader(filename)]
+            return [VtuReader(piece) for piece in PvtuReader(filename).pieces]
+    except TypeError as e:
+        # layouts the native reader does not handle are left to vtk, when it is installed
+        try:
+            import vtk  # noqa: F401
+        except ImportError:
+            raise e
+        return None
+
+def read_vtk_grid(filename, file_type):
+    with profile_phase("import vtk"):
+        import vtk
 
-    # read files:
     if file_type == "vtu":
-        reader1 = vtk.vtkXMLUnstructuredGridReader()
-        reader2 = vtk.vtkXMLUnstructuredGridReader()
+        reader = vtk.vtkXMLUnstructuredGridReader()
     else:
-        reader1 = vtk.vtkXMLPUnstructuredGridReader()
-        reader2 = vtk.vtkXMLPUnstructuredGridReader()
+        reader = vtk.vtkXMLPUnstructuredGridReader()
+
+    reader.SetFileName(filename)
+    with profile_phase("vtk reader update", file = filename):
+        reader.Update()
+    return reader.GetOutput()
+
+def read_vtu_point_data(filename, file_type, streaming = False, use_vtk = False):
+    # list of (name, load) with load() returning the array values
+    piece_readers = open_vtu_pieces(filename, file_type, use_vtk)
+
+    if piece_readers is not None:
+        def loader(i):
+            def load():
+                values = [reader.read_array(reader.point_data_arrays[i]) for reader in piece_readers]
+                return values[0] if len(values) == 1 else np.concatenate(values)
+            return load
+
+        arrays = [(data_array.get("Name"), loader(i))
+                  for i, data_array in enumerate(piece_readers[0].point_data_arrays)]
+        if streaming:
+            # decode each array only when it is compared
+            return arrays
+        return [(name, (lambda values: lambda: values)(load())) for name, load in arrays]
+
+    from vtk.util.numpy_support import vtk_to_numpy
+
+    point_data = read_vtk_grid(filename, file_type).GetPointData()
+
+    # zero-copy numpy views, which keep their vtk arrays alive
+    return [(point_data.GetArrayName(i), (lambda values: lambda: values)(vtk_to_numpy(point_data.GetArray(i))))
+            for i in range(point_data.GetNumberOfArrays())]
+
+def read_vtu_mesh(filename, file_type, use_vtk = False):
+    # (points, connectivity, offsets) of the whole grid, with pieces concatenated
+    # and offsets holding the start of every cell plus the total length
+    piece_readers = open_vtu_pieces(filename, file_type, use_vtk)
+
+    if piece_readers is None:
+        from vtk.util.numpy_support import vtk_to_numpy
+
+        grid = read_vtk_grid(filename, file_type)
+        cells = grid.GetCells()
+        return (vtk_to_numpy(grid.GetPoints().GetData()),
+                vtk_to_numpy(cells.GetConnectivityArray()).astype(np.int64),
+                vtk_to_numpy(cells.GetOffsetsArray()).astype(np.int64))
+
+    points = []
+    connectivity = []
+    offsets = [np.zeros(1, dtype = np.int64)]
+    for reader in piece_readers:
+        # piece connectivities index the points of their own piece
+        if "connectivity" in reader.cell_arrays:
+            connectivity.append(reader.read_array(reader.cell_arrays["connectivity"], (-1,)).astype(np.int64)
+                                + sum(len(p) for p in points))
+            offsets.append(reader.read_array(reader.cell_arrays["offsets"], (-1,)).astype(np.int64)
+                           + offsets[-1][-1])
+        points.append(reader.read_array(reader.points_array))
+
+    return (np.concatenate(points), np.concatenate(connectivity or [np.zeros(0, dtype = np.int64)]),
+            np.concatenate(offsets))
+
+def match_points(mesh1, mesh2, point_tolerance = 1e-10):
+    # index into the points of mesh1 for every point of mesh2, matched by position in O(N log N).
+    # coincident points (dg nodes, piece boundaries) are told apart by the mean centroid
+    # of the cells around them, which does not depend on the cell order
+    def point_features(points, connectivity, offsets):
+        points = np.asarray(points, dtype = np.float64).reshape(len(points), -1)
+
+        counts = np.diff(offsets)
+        cells = np.repeat(np.arange(len(counts)), counts)
+        centroids = np.column_stack([np.bincount(cells, points[connectivity, d], len(counts))
+                                     for d in range(points.shape[1])]) / np.maximum(counts, 1)[:, None]
+
+        # points outside any cell are their own centroid
+        ncells = np.bincount(connectivity, minlength = len(points))
+        star_centroids = np.column_stack([np.bincount(connectivity, centroids[cells, d], len(points))
+                                          for d in range(points.shape[1])])
+        star_centroids = np.where(ncells[:, None] > 0, star_centroids / np.maximum(ncells, 1)[:, None], points)
+        return points, np.hstack((points, star_centroids))
+
+    points1, features1 = point_features(*mesh1)
+    points2, features2 = point_features(*mesh2)
+
+    if features1.shape != features2.shape:
+        print("File 1:", points1.shape, "\n", "File 2:", points2.shape)
+        raise ValueError("Fidelity test failed: Mismatched point count")
+
+    # every coordinate is replaced by the id of its cluster of values less than point_tolerance
+    # apart, over both meshes together, so values within tolerance sort as equal whatever rounding
+    # would make of them and the ids keep the order of the values
+    keys = np.empty((len(features1) + len(features2), features1.shape[1]), dtype = np.int64)
+    for d in range(features1.shape[1]):
+        values = np.concatenate((features1[:, d], features2[:, d]))
+        order = np.argsort(values, kind = "stable")
+        keys[order, d] = np.concatenate(([0], np.cumsum(np.diff(values[order]) > point_tolerance)))
+
+    order1 = np.lexsort(keys[:len(features1)].T[::-1])
+    order2 = np.lexsort(keys[len(features1):].T[::-1])
+
+    mapping = np.empty_like(order1)
+    mapping[order2] = order1
+
+    mismatched = np.count_nonzero(np.any(~(np.abs(points1[mapping] - points2) <= point_tolerance), axis = 1))
+    if mismatched:
+        print("File 1:", len(points1), "points", "\n", "File 2:", mismatched, "points not found in File 1")
+        raise ValueError("Fidelity test failed: Mismatched point coordinates")
+
+    return mapping
+
+def field_executor(nthreads = None):
+    # thread pool for the independent arrays of one file; numpy releases the gil,
+    # so reading one array overlaps with comparing another. none when serial
+    import contextlib
+    from concurrent.futures import ThreadPoolExecutor
+
+    if nthreads == 1:
+        return contextlib.nullcontext()
+    return ThreadPoolExecutor(max_workers = field_workers(nthreads))
+
+def field_workers(nthreads = None):
+    # arrays compared at once by field_executor, the thread pool default when nthreads is not given
+    import os
+
+    return nthreads or min(32, (os.cpu_count() or 1) + 4)
+
+def kernel_threads(nthreads, nfields):
+    # threads left over for the error kernel of each array when a file has fewer arrays than threads
+    import os
 
-    reader1.SetFileName(first_file)
-    reader1.Update()
-    output1 = reader1.GetOutput()
+    return max(1, (nthreads or os.cpu_count() or 1) // max(nfields, 1))
+
+def map_fields(executor, function, items):
+    # results of function over items in order, on the executor if there is one
+    if executor is None:
+        return map(function, items)
+    return executor.map(profile_attach(function), items)
+
+def read_pair(read1, read2):
+    # run the reads of both sides at the same time, returning (value1, value2)
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers = 1) as executor:
+        future = executor.submit(profile_attach(read2))
+        value1 = read1()
+        return value1, future.result()
+
+def compare_sampled(values1, values2, field, tolerance, rtol = 0.0, fraction = 0.01, seed = 0):
+    # quick check of every 1/fraction-th row from a random start, works on arrays and
+    # hdf5 datasets alike, with the worst location mapped back to the full array
+    if values2.shape == ():
+        field.update(np.asarray(values1[()]), np.asarray(values2[()]), tolerance, rtol)
+        return field
+
+    stride = max(1, int(round(1 / fraction)))
+    start = int(np.random.default_rng(seed).integers(stride)) if values2.shape[0] > stride else 0
+    rows = slice(start, None, stride)
+    field.update(np.asarray(values1[rows]), np.asarray(values2[rows]), tolerance, rtol)
+
+    if field.worst_index is not None:
+        row_size = int(np.prod(values2.shape[1:]))
+        row, column = divmod(field.worst_index, row_size)
+        field.worst_index = (start + row * stride) * row_size + column
+
+    field.sampled = True
+    return field
+
+def summary_statistics(values):
+    # min, max, mean and l2 norm, which reveal differences a sample may have missed
+    values = np.asarray(values, dtype = np.float64).reshape(-1)
+    if values.size == 0:
+        return np.zeros(4)
+    return np.array([np.min(values), np.max(values), np.mean(values), np.linalg.norm(values)])
+
+def quick_check(values1, values2, field, tolerance, rtol = 0.0, fraction = 0.01, statistics = True):
+    # sampled comparison into field, plus the summary statistics of arrays already in memory.
+    # every statistic is bounded by the pointwise tolerance, so false means the full check would fail
+    compare_sampled(values1, values2, field, tolerance, rtol, fraction)
+    if not field.passed or not statistics:
+        return field.passed
+
+    # ulp and non-finite policies loosen the pointwise check beyond what the bounds cover
+    limits = field_tolerance(tolerance, field.name, rtol)
+    if limits.ulp is not None or "equal" in (limits.nan, limits.inf):
+        return field.passed
+
+    # |v1 - v2| <= atol + rtol * |v2| bounds the change of min and max by atol + rtol * max|v2|,
+    # of the mean by atol + rtol * mean|v2| and of the l2 norm by sqrt(n) * atol + rtol * |v2|
+    statistics2 = summary_statistics(values2)
+    magnitudes2 = np.zeros(4)
+    if limits.rtol > 0:
+        max_abs2 = max(abs(statistics2[0]), abs(statistics2[1]))
+        mean_abs2 = np.mean(np.abs(np.asarray(values2, dtype = np.float64))) if np.size(values2) else 0.0
+        magnitudes2 = np.array([max_abs2, max_abs2, mean_abs2, statistics2[3]])
+    bounds = limits.atol * np.array([1, 1, 1, np.sqrt(np.size(values2))]) + limits.rtol * magnitudes2
+    return bool(np.all(np.abs(summary_statistics(values1) - statistics2) <= bounds))
+
+def compare_files_vtu(first_file, second_file, file_type, tolerance = 1e-12, hash_first = False,
+                      cache = None, streaming = False, use_vtk = False, nthreads = None, reorder_points = False,
+                      point_tolerance = 1e-10, sample = None, refine = False):
+    # a pvtu reference is only valid as long as its pieces are unchanged
+    dependencies = PvtuReader(first_file).pieces if file_type == "pvtu" else ()
 
-    reader2.SetFileName(second_file)
-    reader2.Update()
-    output2 = reader2.GetOutput()
+    # read files:
+    reference = None if cache is None else cache.lookup(first_file, dependencies)
+    def read_arrays1():
+        if reference is None:
+            return read_vtu_point_data(first_file, file_type, streaming, use_vtk)
+        return [(name, (lambda name: lambda: cache.load_array(first_file, name))(name)) for name in reference]
 
-    # check fidelity
-    point_data1 = output1.GetPointData()
-    point_data2 = output2.GetPointData()
+    arrays1, arrays2 = read_pair(read_arrays1, lambda: read_vtu_point_data(second_file, file_type, streaming, use_vtk))
 
     # verify same number of PointData arrays in both files
-    if point_data1.GetNumberOfArrays() != point_data2.GetNumberOfArrays():
-        print("File 1:", point_data1.GetNumberOfArrays(), "\n", "File 2:", point_data2.GetNumberOfArrays())
+    if len(arrays1) != len(arrays2):
+        print("File 1:", len(arrays1), "\n", "File 2:", len(arrays2))
         raise ValueError("Fidelity test failed: Mismatched data array count")
 
-    for i in range(point_data1.GetNumberOfArrays()):
-        arr1 = point_data1.GetArray(i)
-        arr2 = point_data2.GetArray(i)
+    result = ComparisonResult(first_file, second_file, tolerance)
+    for i in range(len(arrays1)):
+        name1 = arrays1[i][0]
+        name2 = arrays2[i][0]
 
         # verify both files contain same arrays
-        if point_data1.GetArrayName(i) != point_data2.GetArrayName(i):
-            print("File 1:", point_data1.GetArrayName(i), "\n", "File 2:", point_data2.GetArrayName(i))
+        if name1 != name2:
+            print("File 1:", name1, "\n", "File 2:", name2)
             raise ValueError("Fidelity test failed: Mismatched data array names")
 
+    # differently partitioned grids are compared in the point order of the second file
+    mapping = None
+    if reorder_points:
+        with profile_phase("match points"):
+            mapping = match_points(*read_pair(lambda: read_vtu_mesh(first_file, file_type, use_vtk),
+                                              lambda: read_vtu_mesh(second_file, file_type, use_vtk)),
+                                   point_tolerance)
+        if np.array_equal(mapping, np.arange(len(mapping))):
+            mapping = None
+
+    def compare_arrays(i):
+        name1, load1 = arrays1[i]
+        name2, load2 = arrays2[i]
+
+        # only one pair of arrays per thread is held in memory at a time, both sides read together
+        with profile_phase("read arrays", array = name1):
+            values1, values2 = read_pair(load1, load2)
+
+        shape1 = values1.shape if reference is None else tuple(reference[name1]["shape"])
+
         # verify arrays are same sizes in both files
-        if arr1.GetSize() != arr2.GetSize():
-            print("File 1, DataArray", i, ":", arr1.GetSize(), "\n", "File 2, DataArray", i, ":", arr2.GetSize())
+        if shape1 != values2.shape:
+            print("File 1, DataArray", i, ":", shape1, "\n", "File 2, DataArray", i, ":", values2.shape)
             raise ValueError("Fidelity test failed: Mismatched data array sizes")
 
-        # verify individual values w/in given tolerance
-        for j in range(arr1.GetSize()):
-            if abs(arr1.GetValue(j) - arr2.GetValue(j)) > tolerance: 
-                print("Tolerance:", tolerance)
-                raise ValueError("Fidelity test failed: Mismatched data array values with given tolerance")
+        field = FieldErrors(name1, values2.shape, second_file)
+        if reference is not None and mapping is None and array_digest(values2) == reference[name1]["digest"]:
+            # identical to the cached reference, no need to read it
+            field.update_identical(values2, tolerance)
+        else:
+            if values1 is None:
+                # cached fingerprint differs and no data copy is cached, fall back to the file
+                values1 = dict(read_vtu_point_data(first_file, file_type, True, use_vtk))[name1]()
+            matched1 = values1 if mapping is None else values1[mapping]
+
+            # verify individual values w/in given tolerance
+            if hash_first and array_digest(matched1) == array_digest(values2):
+                field.update_identical(matched1, tolerance)
+            elif sample is not None and not refine and quick_check(matched1, values2, field, tolerance,
+                                                                   fraction = sample):
+                # the quick pass found no problem, skip the full comparison
+                pass
+            else:
+                field = FieldErrors(name1, values2.shape, second_file)
+                with profile_phase("compare array", array = name1):
+                    field.update(matched1, values2, tolerance, nthreads = array_threads)
+
+        fingerprint = None
+        if reference is None and cache is not None:
+            fingerprint = cache.fingerprint(first_file, name1, values1.dtype, values1.shape)
+            fingerprint.update(values1)
+
+        return field, fingerprint
+
+    fingerprints = {}
+    # streaming holds one pair of arrays in memory at a time unless more threads are asked for,
+    # the error kernel of that pair may still use every core
+    field_threads = 1 if streaming and nthreads is None else nthreads
+    array_threads = kernel_threads(nthreads, len(arrays1) if field_threads != 1 else 1)
+    with field_executor(field_threads) as executor:
+        for field, fingerprint in map_fields(executor, compare_arrays, range(len(arrays1))):
+            result.fields[field.name] = field
+            if fingerprint is not None:
+                fingerprints[field.name] = fingerprint
+
+            if field.sampled:
+                print("DataArray", field.name, ":", "sampled", field.count, "of", np.prod(field.shape), "values,",
+                      "max abs err", field.max_abs_err, "max rel err", field.max_rel_err)
+            else:
+                print("DataArray", field.name, ":", "max abs err", field.max_abs_err, "max rel err", field.max_rel_err)
+
+    if reference is None and cache is not None:
+        cache.store(first_file, fingerprints, dependencies)
+
+    if not result.passed:
+        print("Tolerance:", tolerance, "\n", "DataArrays:", result.failed_fields)
+        raise FidelityError("Fidelity test failed: Mismatched data array values with given tolerance", result)
 
     print("VTU Fidelity test completed successfully with tolerance", tolerance)
+    return result
+
+class PvtuReader():
+    def __init__(self, filename):
+        import os
+        import xml.etree.ElementTree as ET
+
+        with profile_phase("parse pvtu", file = filename):
+            root = ET.parse(filename).getroot()
+        grid = root.find("PUnstructuredGrid")
+        if grid is None:
+            raise TypeError("File is not a parallel unstructured grid")
+
+        # piece sources are relative to the .pvtu file
+        base_dir = os.path.dirname(filename)
+        self.pieces = [os.path.join(base_dir, piece.get("Source")) for piece in grid.iter("Piece")]
+
+        point_data = grid.find("PPointData")
+        self.point_data_names = [] if point_data is None else [a.get("Name") for a in point_data]
+
+def compare_files_pvtu_pieces(first_file, second_file, tolerance = 1e-12, nprocs = None, comm = None,
+                              **compare_options):
+    # compare matching .vtu pieces independently instead of assembling the global grid
+    file_reader1 = PvtuReader(first_file)
+    file_reader2 = PvtuReader(second_file)
+
+    if file_reader1.point_data_names != file_reader2.point_data_names:
+        print("File 1:", file_reader1.point_data_names, "\n", "File 2:", file_reader2.point_data_names)
+        raise ValueError("Fidelity test failed: Mismatched data array names")
+
+    if len(file_reader1.pieces) != len(file_reader2.pieces):
+        print("File 1:", len(file_reader1.pieces), "\n", "File 2:", len(file_reader2.pieces))
+        raise ValueError("Fidelity test failed: Mismatched piece count")
+
+    pairs = list(zip(file_reader1.pieces, file_reader2.pieces))
+    result = ComparisonResult(first_file, second_file, tolerance)
+    if comm is not None:
+        result.merge(compare_file_pairs_mpi(pairs, tolerance, comm, **compare_options))
+    else:
+        result.merge(compare_file_pairs(pairs, tolerance, nprocs, **compare_options))
+
+    failures = result.failed_pairs
+    if comm is None or comm.rank == 0:
+        result.print_summary()
+        print("Compared", len(pairs), "pieces:", len(pairs) - len(failures), "passed,", len(failures), "failed")
+
+    if failures:
+        raise FidelityError("Fidelity test failed: Mismatched pieces", result)
+
+    if comm is None or comm.rank == 0:
+        print("PVTU Fidelity test completed successfully with tolerance", tolerance)
+    return result
 
 class Hdf5Reader():
     def __init__(self, filename):
         import h5py
 
-        self.file_obj = h5py.File(filename, 'r')
+        with profile_phase("open hdf5", file = filename):
+            self.file_obj = h5py.File(filename, 'r')
     
     def read_specific_data(self, datapath):
         return self.file_obj[datapath]
 
+    def close(self):
+        self.file_obj.close()
+
+class Hdf5FilePool():
+    # bounded pool of open hdf5 files, so each backing file is opened once per comparison
+
+    def __init__(self, max_open_files = 64):
+        import threading
+        from collections import OrderedDict
+
+        self.max_open_files = max_open_files
+        self.readers = OrderedDict()
+        self.leases = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get(self, filename):
+        import os
+
+        key = os.path.abspath(filename)
+        with self.lock:
+            if key in self.readers:
+                self.readers.move_to_end(key)
+            else:
+                # close the least recently used file not leased by a running comparison
+                if len(self.readers) >= self.max_open_files:
+                    for old_key in self.readers:
+                        if not self.leases.get(old_key):
+                            self.readers.pop(old_key).close()
+                            break
+
+                self.readers[key] = Hdf5Reader(filename)
+
+            leased = getattr(self.local, "leased", None)
+            if leased is not None:
+                self.leases[key] = self.leases.get(key, 0) + 1
+                leased.append(key)
+
+            return self.readers[key]
+
+    def lease(self):
+        import contextlib
+
+        # files opened by this thread inside the block stay open until it exits
+        @contextlib.contextmanager
+        def leased_files():
+            self.local.leased = []
+            try:
+                yield
+            finally:
+                with self.lock:
+                    for key in self.local.leased:
+                        self.leases[key] -= 1
+                self.local.leased = None
+
+        return leased_files()
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+        self.readers.clear()
+
+XDMF_NUMBER_TYPES = {
+    ("Float", "4"): np.float32, ("Float", "8"): np.float64,
+    ("Int", "1"): np.int8, ("Int", "2"): np.int16, ("Int", "4"): np.int32, ("Int", "8"): np.int64,
+    ("UInt", "1"): np.uint8, ("UInt", "2"): np.uint16, ("UInt", "4"): np.uint32, ("UInt", "8"): np.uint64,
+    ("Char", "1"): np.int8, ("UChar", "1"): np.uint8,
+    }
+
 class XdmfReader():
-    # CURRENTLY DOES NOT SUPPORT MULTIPLE Grids
+    # supports uniform grids nested in spatial and temporal collections
 
-    def __init__(self, filename): 
+    def __init__(self, filename, file_pool = None): 
+        import os
         import xml.etree.ElementTree as ET
 
-        tree = ET.parse(filename)
+        self.file_pool = Hdf5FilePool() if file_pool is None else file_pool
+
+        # hdf5 files are referenced relative to the xdmf file
+        self.base_dir = os.path.dirname(filename)
+
+        with profile_phase("parse xdmf", file = filename):
+            tree = ET.parse(filename)
         root = tree.getroot()
 
         domains = tuple(root)
         self.domain = domains[0]
         self.grids = tuple(self.domain)
-        self.uniform_grid = self.grids[0]
-
-    def get_topology(self):
+        self.uniform_grids = list(self._iter_uniform_grids(self.domain, ""))
+
+        if not self.uniform_grids:
+            raise ValueError("File is missing grid data")
+        self.uniform_grid = self.uniform_grids[0][1]
+
+    def hdf5_files(self):
+        import os
+
+        # hdf5 files referenced by the data items of all grids
+        filenames = []
+        for data_item in self.domain.iter("DataItem"):
+            if data_item.get("Format") == "HDF":
+                filename = os.path.join(self.base_dir, data_item.text.strip().partition(":")[0])
+                if filename not in filenames:
+                    filenames.append(filename)
+        return filenames
+
+    def _iter_uniform_grids(self, element, prefix):
+        # yield (label, grid) for every uniform grid, walking into grid collections
+        for i, grid in enumerate(element.findall("Grid")):
+            label = prefix + grid.get("Name", str(i))
+            if grid.get("GridType") in ("Collection", "Tree"):
+                yield from self._iter_uniform_grids(grid, label + "/")
+            else:
+                yield label, grid
+
+    def get_time(self, grid = None):
+        grid = self.uniform_grid if grid is None else grid
+
+        time = grid.find("Time")
+        return None if time is None else time.get("Value")
+
+    def get_attributes(self, grid = None):
+        grid = self.uniform_grid if grid is None else grid
+
+        return grid.findall("Attribute")
+
+    def get_topology(self, grid = None):
+        grid = self.uniform_grid if grid is None else grid
         connectivity = None
 
-        for a in self.uniform_grid:
+        for a in grid:
             if a.tag == "Topology":
                 connectivity = a
 
@@ -83,10 +1557,11 @@ class XdmfReader():
 
         return connectivity
 
-    def get_geometry(self):
+    def get_geometry(self, grid = None):
+        grid = self.uniform_grid if grid is None else grid
         geometry = None
 
-        for a in self.uniform_grid:
+        for a in grid:
             if a.tag == "Geometry":
                 geometry = a
         
@@ -96,45 +1571,104 @@ class XdmfReader():
         return geometry
             
     def read_data_item(self, data_item):
-        # CURRENTLY DOES NOT SUPPORT 'DataItem' THAT STORES VALUES DIRECTLY
+        import os
+
+        # values stored directly in the xml
+        if data_item.get("Format", "XML") == "XML":
+            number_type = XDMF_NUMBER_TYPES.get(
+                (data_item.get("NumberType", "Float"), data_item.get("Precision", "4")))
+            if number_type is None:
+                raise TypeError("Data stored in unrecognized number type")
+
+            values = np.array(data_item.text.split(), dtype = number_type)
+            dimensions = data_item.get("Dimensions")
+            if dimensions is not None:
+                values = values.reshape([int(d) for d in dimensions.split()])
+            return values
 
         # check that data stored as separate hdf5 file
         if data_item.get("Format") != "HDF":
             raise TypeError("Data stored in unrecognized format")
         
         # get corresponding hdf5 file
-        source_info = data_item.text
+        source_info = data_item.text.strip()
         split_source_info = source_info.partition(":")
 
-        h5_filename = split_source_info[0]
-        # TODO: change file name to match actual mirgecom output directory later
-        h5_filename = "examples/" + h5_filename
+        h5_filename = os.path.join(self.base_dir, split_source_info[0])
         h5_datapath = split_source_info[2]
 
         # read data from corresponding hdf5 file
-        h5_reader = Hdf5Reader(h5_filename)
+        h5_reader = self.file_pool.get(h5_filename)
         return h5_reader.read_specific_data(h5_datapath)
 
-import numpy as np
+def compare_files_xdmf(first_file, second_file, tolerance = 1e-12, hash_first = False,
+                       memory_limit = 256 * 2**20, nthreads = None):
+    from concurrent.futures import ThreadPoolExecutor
+
+    # read files, sharing one pool of open hdf5 files between both sides
+    file_pool = Hdf5FilePool()
+    try:
+        file_reader1 = XdmfReader(first_file, file_pool)
+        file_reader2 = XdmfReader(second_file, file_pool)
+
+        # check same number of grids
+        if len(file_reader1.uniform_grids) != len(file_reader2.uniform_grids):
+            print("File 1:", len(file_reader1.uniform_grids), "\n", "File 2:", len(file_reader2.uniform_grids))
+            raise ValueError("Fidelity test failed: Mismatched grid count")
+
+        result = ComparisonResult(first_file, second_file, tolerance)
+
+        # a single grid keeps plain array names
+        single_grid = len(file_reader1.uniform_grids) == 1
+
+        # arrays of all grids share one pool, separate from the grid threads waiting on them,
+        # and the memory budget is shared by the arrays that pool compares at once
+        array_memory = memory_limit // field_workers(nthreads)
+        with field_executor(nthreads) as array_executor:
+            def compare_grids(grid_pairs):
+                (label1, grid1), (label2, grid2) = grid_pairs
+                grid_result = ComparisonResult(first_file, second_file, tolerance)
+                with file_pool.lease():
+                    _compare_xdmf_grids(file_reader1, file_reader2, grid1, grid2, grid_result,
+                                        "" if single_grid else label1 + "/", hash_first, array_memory,
+                                        array_executor)
+                return grid_result
+
+            # compare time steps and spatial grids concurrently
+            with ThreadPoolExecutor(max_workers = nthreads) as executor:
+                for grid_result in executor.map(
+                        profile_attach(compare_grids), zip(file_reader1.uniform_grids, file_reader2.uniform_grids)):
+                    result.merge(grid_result)
+    finally:
+        file_pool.close()
+
+    if not result.passed:
+        print("Tolerance:", result.tolerance, "\n", "Cells:", result.failed_fields)
+        raise FidelityError("Fidelity test failed: Mismatched data values with given tolerance", result)
 
-def compare_files_xdmf(first_file, second_file, tolerance = 1e-12):
-    # read files
-    file_reader1 = XdmfReader(first_file)
-    file_reader2 = XdmfReader(second_file)
+    print("XDMF Fidelity test completed successfully with tolerance", tolerance)
+    return result
+
+def _compare_xdmf_grids(file_reader1, file_reader2, grid1, grid2, result, prefix, hash_first, memory_limit,
+                        executor = None):
+    tolerance = result.tolerance
+
+    # (field, values1, values2, rtol) of the arrays to compare once the grid layout is checked
+    comparisons = []
+
+    # check same time step
+    if file_reader1.get_time(grid1) != file_reader2.get_time(grid2):
+        print("File 1:", file_reader1.get_time(grid1), "\n", "File 2:", file_reader2.get_time(grid2))
+        raise ValueError("Fidelity test failed: Mismatched time values")
 
-    # check same number of grids
-    if len(file_reader1.grids) != len(file_reader2.grids):
-        print("File 1:", len(file_reader1.grids), "\n", "File 2:", len(file_reader2.grids))
-        raise ValueError("Fidelity test failed: Mismatched grid count")
-    
     # check same number of cells in grid
-    if len(file_reader1.uniform_grid) != len(file_reader2.uniform_grid):
-        print("File 1:", len(file_reader1.uniform_grid), "\n", "File 2:", len(file_reader2.uniform_grid))
+    if len(grid1) != len(grid2):
+        print("File 1:", len(grid1), "\n", "File 2:", len(grid2))
         raise ValueError("Fidelity test failed: Mismatched cell count in uniform grid")
 
     # compare Topology: 
-    top1 = file_reader1.get_topology()
-    top2 = file_reader2.get_topology()
+    top1 = file_reader1.get_topology(grid1)
+    top2 = file_reader2.get_topology(grid2)
 
     # check TopologyType
     if top1.get("TopologyType") != top2.get("TopologyType"):
@@ -145,20 +1679,16 @@ def compare_files_xdmf(first_file, second_file, tolerance = 1e-12):
     connectivities1 = file_reader1.read_data_item(tuple(top1)[0])
     connectivities2 = file_reader2.read_data_item(tuple(top2)[0])
 
-    connectivities1 = np.array(connectivities1)
-    connectivities2 = np.array(connectivities2)
-
     if connectivities1.shape != connectivities2.shape:
         print("File 1:", connectivities1.shape, "\n", "File 2:", connectivities2.shape)
         raise ValueError("Fidelity test failed: Mismatched connectivities count")
     
-    if not np.allclose(connectivities1, connectivities2, atol = tolerance):
-        print("Tolerance:", tolerance)
-        raise ValueError("Fidelity test failed: Mismatched connectivity values with given tolerance")
+    field = result.add_field(prefix + "Connectivity", connectivities2.shape)
+    comparisons.append((field, connectivities1, connectivities2, 1e-5))
 
     # compare Geometry:
-    geo1 = file_reader1.get_geometry()
-    geo2 = file_reader2.get_geometry()
+    geo1 = file_reader1.get_geometry(grid1)
+    geo2 = file_reader2.get_geometry(grid2)
 
     # check GeometryType
     if geo1.get("GeometryType") != geo2.get("GeometryType"):
@@ -169,26 +1699,15 @@ def compare_files_xdmf(first_file, second_file, tolerance = 1e-12):
     nodes1 = file_reader1.read_data_item(tuple(geo1)[0])
     nodes2 = file_reader2.read_data_item(tuple(geo2)[0])
 
-    nodes1 = np.array(nodes1)
-    nodes2 = np.array(nodes2)
-
     if nodes1.shape != nodes2.shape:
         print("File 1:", nodes1.shape, "\n", "File 2:", nodes2.shape)
         raise ValueError("Fidelity test failed: Mismatched nodes count")
     
-    if not np.allclose(nodes1, nodes2, atol = tolerance):
-        print("Tolerance:", tolerance)
-        raise ValueError("Fidelity test failed: Mismatched node values with given tolerance")
+    field = result.add_field(prefix + "Nodes", nodes2.shape)
+    comparisons.append((field, nodes1, nodes2, 1e-5))
 
     # compare other Attributes:
-    for i in range(len(file_reader1.uniform_grid)):
-        curr_cell1 = file_reader1.uniform_grid[i]
-        curr_cell2 = file_reader2.uniform_grid[i]
-
-        # skip already checked cells
-        if curr_cell1.tag == "Geometry" or curr_cell1.tag == "Topology":
-            continue
-
+    for curr_cell1, curr_cell2 in zip(file_reader1.get_attributes(grid1), file_reader2.get_attributes(grid2)):
         # check AttributeType
         if curr_cell1.get("AttributeType") != curr_cell2.get("AttributeType"):
             print("File 1:", curr_cell1.get("AttributeType"), "\n", "File 2:", curr_cell2.get("AttributeType"))
@@ -203,104 +1722,804 @@ def compare_files_xdmf(first_file, second_file, tolerance = 1e-12):
         values1 = file_reader1.read_data_item(tuple(curr_cell1)[0])
         values2 = file_reader2.read_data_item(tuple(curr_cell2)[0])
 
-        if len(values1) != len(values2):
-            print("File 1,", curr_cell1.get("Name"), ":", len(values1), "\n", "File 2,", curr_cell2.get("Name"), ":", len(values2))
+        if values1.shape != values2.shape:
+            print("File 1,", curr_cell1.get("Name"), ":", values1.shape, "\n", "File 2,", curr_cell2.get("Name"), ":", values2.shape)
             raise ValueError("Fidelity test failed: Mismatched data values count")
 
         # check values w/in tolerance
-        for i in range(len(values1)):
-            if abs(values1[i] - values2[i]) > tolerance:
-                print("Tolerance:", tolerance, "\n", "Cell:", curr_cell1.get("Name"))
-                raise ValueError("Fidelity test failed: Mismatched data values with given tolerance")
+        field = result.add_field(prefix + curr_cell1.get("Name"), values2.shape)
+        comparisons.append((field, values1, values2, 0.0))
+
+    def compare_arrays(comparison):
+        field, values1, values2, rtol = comparison
+        return compare_dataset_blocks(values1, values2, field, tolerance, rtol, memory_limit, hash_first)
+
+    # wait for all arrays of this grid, re-raising any read error
+    list(map_fields(executor, compare_arrays, comparisons))
+
+def iter_dataset_blocks(dataset, max_block_bytes):
+    # yield slices along the first axis that fit in max_block_bytes,
+    # rounded to whole hdf5 chunks so each chunk is read (and decompressed) once
+    if dataset.shape == ():
+        yield ()
+        return
+
+    row_bytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+    rows = max(1, max_block_bytes // max(row_bytes, 1))
+
+    chunks = getattr(dataset, "chunks", None)
+    if chunks is not None:
+        chunk_rows = chunks[0]
+        rows = max(chunk_rows, rows - rows % chunk_rows)
+
+    for start in range(0, dataset.shape[0], rows):
+        yield slice(start, min(start + rows, dataset.shape[0]))
+
+def compare_dataset_blocks(dataset1, dataset2, field, tolerance, rtol = 0.0, memory_limit = 256 * 2**20,
+                           hash_first = False, fingerprint = None, nthreads = 1):
+    from concurrent.futures import ThreadPoolExecutor
+
+    # stream both datasets block by block, aligned to the hdf5 chunk layout,
+    # accumulating the errors into field
+    name = getattr(dataset2, "name", None)
+
+    def read_blocks(block):
+        with profile_phase("read blocks", array = name):
+            return read_pair(lambda: np.asarray(dataset1[block]), lambda: np.asarray(dataset2[block]))
+
+    # the next pair of blocks is read while the current one is compared,
+    # so two pairs share the memory budget
+    row_size = int(np.prod(dataset1.shape[1:]))
+    blocks = list(iter_dataset_blocks(dataset1, memory_limit // 4))
+    with ThreadPoolExecutor(max_workers = 1) as executor:
+        read_blocks = profile_attach(read_blocks)
+        next_blocks = executor.submit(read_blocks, blocks[0]) if blocks else None
+        for i, block in enumerate(blocks):
+            block1, block2 = next_blocks.result()
+            if i + 1 < len(blocks):
+                next_blocks = executor.submit(read_blocks, blocks[i + 1])
+
+            if fingerprint is not None:
+                fingerprint.update(block1)
+
+            # identical blocks need no tolerance check
+            offset = block.start * row_size if isinstance(block, slice) else 0
+            if hash_first and array_digest(block1) == array_digest(block2):
+                field.update_identical(block1, tolerance, rtol, offset)
+                continue
+
+            with profile_phase("compare block", array = name):
+                field.update(block1, block2, tolerance, rtol, offset, nthreads)
+
+    return field
+
+def dataset_digest(dataset, memory_limit = 256 * 2**20):
+    # content digest of an hdf5 dataset, streamed so it matches array_digest of the full data
+    fingerprint = ArrayFingerprint(dataset.dtype, dataset.shape)
+    for block in iter_dataset_blocks(dataset, memory_limit):
+        fingerprint.digest.update(memoryview(np.ascontiguousarray(dataset[block])).cast("B"))
+    return fingerprint.hexdigest()
+
+def hdf5_tree(file_obj):
+    # {path: (object, attributes)} of every group and dataset, gathered in a single traversal
+    tree = {"": (file_obj, dict(file_obj.attrs))}
+
+    def visit(name, obj):
+        tree[name] = (obj, dict(obj.attrs))
+
+    with profile_phase("walk hdf5", file = file_obj.filename):
+        file_obj.visititems(visit)
+    return tree
+
+def compare_hdf5_attributes(path, attributes1, attributes2, result, tolerance, rtol = 0.0):
+    # numeric attributes are compared like data, anything else must match exactly
+    if sorted(attributes1) != sorted(attributes2):
+        print("File 1,", path, ":", sorted(attributes1), "\n", "File 2,", path, ":", sorted(attributes2))
+        raise ValueError("Fidelity test failed: Mismatched attribute names")
+
+    for name in sorted(attributes1):
+        value1 = np.asarray(attributes1[name])
+        value2 = np.asarray(attributes2[name])
+
+        if value1.shape != value2.shape:
+            print("File 1,", path, name, ":", value1.shape, "\n", "File 2,", path, name, ":", value2.shape)
+            raise ValueError("Fidelity test failed: Mismatched attribute size")
+
+        if np.issubdtype(value1.dtype, np.number) and np.issubdtype(value2.dtype, np.number):
+            result.add_field(path + "@" + name, value2.shape).update(value1, value2, tolerance, rtol)
+        elif not np.array_equal(value1, value2):
+            print("File 1,", path, name, ":", value1, "\n", "File 2,", path, name, ":", value2)
+            raise ValueError("Fidelity test failed: Mismatched attribute values")
+
+def compare_files_hdf5(first_file, second_file, tolerance = 1e-12, memory_limit = 256 * 2**20,
+                       hash_first = False, cache = None, nthreads = None, sample = None, refine = False):
+    import h5py
 
-    print("XDMF Fidelity test completed successfully with tolerance", tolerance)
-
-def compare_files_hdf5(first_file, second_file, tolerance = 1e-12):
     file_reader1 = Hdf5Reader(first_file)
     file_reader2 = Hdf5Reader(second_file)
 
-    f1 = file_reader1.file_obj
-    f2 = file_reader2.file_obj
+    # objects are matched by path, so any nesting depth and ordering is supported
+    tree1 = hdf5_tree(file_reader1.file_obj)
+    tree2 = hdf5_tree(file_reader2.file_obj)
 
-    objects1 = list(f1.keys()) 
-    objects2 = list(f2.keys())
+    kinds1 = {path: type(obj).__name__ for path, (obj, _) in tree1.items()}
+    kinds2 = {path: type(obj).__name__ for path, (obj, _) in tree2.items()}
+    if kinds1 != kinds2:
+        print("File 1:", sorted(set(kinds1.items()) - set(kinds2.items())), "\n",
+              "File 2:", sorted(set(kinds2.items()) - set(kinds1.items())))
+        raise ValueError("Fidelity test failed: Mismatched objects")
 
-    # check number of Grids
-    if len(objects1) != len(objects2):
-        print("File 1:", len(objects1), "\n", "File 2:", len(objects2))
-        raise ValueError("Fidelity test failed: Mismatched grid count")
+    reference = None if cache is None else cache.lookup(first_file)
+    result = ComparisonResult(first_file, second_file, tolerance)
 
-    # loop through Grids
-    for i in range(len(objects1)):
-        obj_name1 = objects1[i] 
-        obj_name2 = objects2[i]
+    # metadata is checked up front, datasets are then compared independently
+    datasets = []
+    for path in sorted(tree1):
+        curr_datalist1, attributes1 = tree1[path]
+        curr_datalist2, attributes2 = tree2[path]
 
-        if obj_name1 != obj_name2:
-            print("File 1:", obj_name1, "\n", "File 2:", obj_name2)
-            raise ValueError("Fidelity test failed: Mismatched grid names")
+        compare_hdf5_attributes(path, attributes1, attributes2, result, tolerance, 1e-5)
 
-        curr_o1 = list(f1[obj_name1]) 
-        curr_o2 = list(f2[obj_name2])
+        if not isinstance(curr_datalist1, h5py.Dataset):
+            continue
 
-        if len(curr_o1) != len(curr_o2):
-            print("File 1,", obj_name1, ":", len(curr_o1), "\n", "File 2,", obj_name2, ":", len(curr_o2))
-            raise ValueError("Fidelity test failed: Mismatched group count")
+        if curr_datalist1.shape != curr_datalist2.shape:
+            print("File 1,", path, ":", curr_datalist1.shape, "\n",
+                  "File 2,", path, ":", curr_datalist2.shape)
+            raise ValueError("Fidelity test failed: Mismatched data list size")
+
+        datasets.append(path)
+
+    dataset_threads = kernel_threads(nthreads, len(datasets))
+    # the memory budget is shared by the datasets compared at once
+    dataset_memory = memory_limit // max(1, min(field_workers(nthreads), len(datasets)))
+
+    def compare_datasets(path):
+        curr_datalist1 = tree1[path][0]
+        curr_datalist2 = tree2[path][0]
+
+        source1 = curr_datalist1
+        fingerprint = None
+        field = FieldErrors(path, curr_datalist2.shape, second_file)
+        if reference is not None and path in reference:
+            # identical to the cached reference, no need to read it
+            if dataset_digest(curr_datalist2, dataset_memory) == reference[path]["digest"]:
+                row_size = int(np.prod(curr_datalist2.shape[1:]))
+                for block in iter_dataset_blocks(curr_datalist2, dataset_memory):
+                    offset = block.start * row_size if isinstance(block, slice) else 0
+                    field.update_identical(curr_datalist2[block], tolerance, 1e-5, offset)
+                return field, fingerprint, True
+
+            cached_data = cache.load_array(first_file, path)
+            if cached_data is not None:
+                source1 = cached_data
+        elif cache is not None:
+            fingerprint = cache.fingerprint(first_file, path, curr_datalist1.dtype, curr_datalist1.shape)
+
+        if sample is not None and not refine and fingerprint is None:
+            # the full comparison only runs when the quick pass finds a problem,
+            # statistics of the whole datasets would need a full read
+            if quick_check(source1, curr_datalist2, field, tolerance, 1e-5, sample, statistics = False):
+                return field, fingerprint, False
+            field = FieldErrors(path, curr_datalist2.shape, second_file)
+
+        compare_dataset_blocks(source1, curr_datalist2, field, tolerance, 1e-5, dataset_memory,
+                               hash_first, fingerprint, dataset_threads)
+        return field, fingerprint, False
+
+    fingerprints = {}
+    with field_executor(nthreads) as executor:
+        for field, fingerprint, cached in map_fields(executor, compare_datasets, datasets):
+            result.fields[field.name] = field
+            if fingerprint is not None:
+                fingerprints[field.name] = fingerprint
+
+            if cached:
+                print("Data List", field.name, ":", "identical to cached reference")
+            elif field.sampled:
+                print("Data List", field.name, ":", "sampled", field.count, "of", np.prod(field.shape), "values,",
+                      "max abs err", field.max_abs_err, "max rel err", field.max_rel_err)
+            else:
+                print("Data List", field.name, ":", "max abs err", field.max_abs_err, "max rel err", field.max_rel_err)
+
+    file_reader1.close()
+    file_reader2.close()
+
+    if cache is not None and reference is None:
+        cache.store(first_file, fingerprints)
+
+    if not result.passed:
+        print("Tolerance:", tolerance, "\n", "Data Lists:", result.failed_fields)
+        raise FidelityError("Fidelity test failed: Mismatched data values with given tolerance", result)
 
-        # loop through Groups
-        for j in range(len(curr_o1)):
-            subobj_name1 = curr_o1[j] 
-            subobj_name2 = curr_o2[j]
+    print("HDF5 Fidelity test completed successfully with tolerance", tolerance)
+    return result
 
-            if subobj_name1 != subobj_name2:
-                print("File 1:", subobj_name1, "\n", "File 2:", subobj_name2)
-                raise ValueError("Fidelity test failed: Mismatched group names")
+SUPPORTED_FILE_TYPES = ("vtu", "pvtu", "xmf", "h5")
 
-            subpath1 = obj_name1 + "/" + subobj_name1
-            subpath2 = obj_name2 + "/" + subobj_name2
+def compare_files(first_file, second_file, tolerance = 1e-12, memory_limit = 256 * 2**20,
+                  pvtu_pieces = False, nprocs = None, comm = None, hash_first = False, cache = None,
+                  streaming = False, use_vtk = False, nthreads = None, reorder_points = False,
+                  point_tolerance = 1e-10, sample = None, refine = False):
+    import os
 
-            data_arrays_list1 = list(f1[subpath1])
-            data_arrays_list2 = list(f2[subpath2])
+    file_type = os.path.splitext(first_file)[1][1:]
+
+    # the whole comparison of one pair is a single phase in the profile
+    with profile_phase("compare " + file_type, file = second_file):
+        # bitwise identical self-contained files need no numerical comparison,
+        # as long as no field fails on nan or inf values
+        if (hash_first and file_type in ("vtu", "h5") and accepts_identical(tolerance)
+                and files_identical(first_file, second_file)):
+            print("Files are identical, skipping tolerance comparison")
+            return ComparisonResult(first_file, second_file, tolerance)
+
+        # use appropriate comparison function for file type
+        # matching points across partitions needs the whole grid
+        if file_type == "pvtu" and (pvtu_pieces or comm is not None) and not reorder_points:
+            return compare_files_pvtu_pieces(first_file, second_file, tolerance, nprocs, comm,
+                                             memory_limit = memory_limit, hash_first = hash_first, cache = cache,
+                                             streaming = streaming, use_vtk = use_vtk, nthreads = nthreads,
+                                             sample = sample, refine = refine)
+        elif file_type == "vtu" or file_type == "pvtu":
+            return compare_files_vtu(first_file, second_file, file_type, tolerance, hash_first, cache, streaming,
+                                     use_vtk, nthreads, reorder_points, point_tolerance, sample, refine)
+        elif file_type == "xmf":
+            return compare_files_xdmf(first_file, second_file, tolerance, hash_first, memory_limit, nthreads)
+        elif file_type == "h5":
+            return compare_files_hdf5(first_file, second_file, tolerance, memory_limit, hash_first, cache, nthreads,
+                                      sample, refine)
+        else:
+            raise TypeError("File type not supported")
+
+def pair_directory_files(first_dir, second_dir, pattern = "*"):
+    import fnmatch
+    import os
+
+    # pair files by name, keeping only supported types matching the pattern
+    def matching_names(directory):
+        return set(
+            name for name in os.listdir(directory)
+            if fnmatch.fnmatch(name, pattern)
+            and os.path.splitext(name)[1][1:] in SUPPORTED_FILE_TYPES
+            and os.path.isfile(os.path.join(directory, name)))
+
+    names1 = matching_names(first_dir)
+    names2 = matching_names(second_dir)
 
-            if len(data_arrays_list1) != len(data_arrays_list2):
-                print("File 1,", subobj_name1, ":", len(data_arrays_list1), "\n", "File 2,", subobj_name2, ":", len(data_arrays_list2))
-                raise ValueError("Fidelity test failed: Mismatched data list count")
+    pairs = [(os.path.join(first_dir, name), os.path.join(second_dir, name))
+             for name in sorted(names1 & names2)]
+    return pairs, sorted(names1 - names2), sorted(names2 - names1)
+
+def comparison_files(filename):
+    import os
 
-            # loop through data arrays
-            for k in range(len(data_arrays_list1)):
-                curr_listname1 = data_arrays_list1[k] 
-                curr_listname2 = data_arrays_list2[k]
+    # the file and the data files it references, all read when it is compared
+    file_type = os.path.splitext(filename)[1][1:]
+    if file_type == "pvtu":
+        return [filename] + PvtuReader(filename).pieces
+    elif file_type == "xmf":
+        return [filename] + XdmfReader(filename).hdf5_files()
+    return [filename]
+
+def prefetch_files(filenames, block_size = 2**24):
+    # read files once so a following comparison is served from the os page cache
+    buffer = bytearray(block_size)
+    for filename in filenames:
+        with open(filename, "rb", buffering = 0) as f:
+            while f.readinto(buffer):
+                pass
+
+def prefetch_pair(file_pair):
+    try:
+        prefetch_files(comparison_files(file_pair[0]) + comparison_files(file_pair[1]))
+    except Exception:
+        # unreadable files are reported by the comparison itself
+        pass
+
+def _compare_file_pair(file_pair, tolerance, compare_options):
+    import contextlib
+    import io
+
+    # run one comparison in a worker, capturing its output instead of interleaving it
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            result = compare_files(file_pair[0], file_pair[1], tolerance, **compare_options)
+    except FidelityError as e:
+        return file_pair, False, log.getvalue() + str(e), e.result
+    except Exception as e:
+        # an unreadable pair, e.g. malformed xml or a missing array, fails without ending the run
+        return file_pair, False, log.getvalue() + "%s: %s" % (type(e).__name__, e), None
+    finally:
+        # worker processes hand their profile to the main process
+        if _profiler is not None:
+            _profiler.flush_worker()
+
+    return file_pair, True, log.getvalue(), result
+
+def _serial_arrays(compare_options):
+    # pairs already run in parallel, so their arrays are compared serially unless asked otherwise
+    if compare_options.get("nthreads") is None:
+        return dict(compare_options, nthreads = 1)
+    return compare_options
+
+def compare_file_pairs(file_pairs, tolerance = 1e-12, nprocs = None, **compare_options):
+    import os
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from functools import partial
+
+    # compare pairs on a process pool sized to the machine,
+    # returning the merged result with the failed pairs
+    result = ComparisonResult(None, None, tolerance)
+
+    def collect(future):
+        file_pair, passed, log, pair_result = future.result()
+        if pair_result is not None:
+            result.merge(pair_result)
+        if not passed:
+            result.failed_pairs.append(file_pair)
+            print("FAILED:", file_pair[0], "vs", file_pair[1], "\n", log)
+
+    workers = nprocs or os.cpu_count() or 1
+    prefetcher = ThreadPoolExecutor(max_workers = 1)
+    try:
+        with ProcessPoolExecutor(max_workers = nprocs) as executor:
+            compare_pair = partial(_compare_file_pair, tolerance = tolerance,
+                               compare_options = _serial_arrays(compare_options))
+
+            # keep a bounded queue of pairs behind the running ones,
+            # warming the page cache for each queued pair while it waits
+            pending = deque()
+            for file_pair in file_pairs:
+                if len(pending) >= workers:
+                    prefetcher.submit(prefetch_pair, file_pair)
+                pending.append(executor.submit(compare_pair, file_pair))
+                if len(pending) >= 2 * workers:
+                    collect(pending.popleft())
+
+            while pending:
+                collect(pending.popleft())
+    finally:
+        prefetcher.shutdown(cancel_futures = True)
+
+    return result
+
+def _gather_rank_results(comm, rank_result, error = None):
+    # a rank whose comparison raised still joins the gather, so the others do not wait on it
+    # forever, and then every rank raises
+    message = None if error is None else "%s: %s" % (type(error).__name__, error)
+    gathered = comm.allgather((rank_result, message))
+    if error is not None:
+        raise error
+
+    failed_ranks = {rank: message for rank, (_, message) in enumerate(gathered) if message is not None}
+    if failed_ranks:
+        print("Failed ranks:", failed_ranks)
+        raise ValueError("Fidelity test failed: Comparison raised on another rank")
+    return [other for other, _ in gathered]
+
+def compare_file_pairs_mpi(file_pairs, tolerance = 1e-12, comm = None, **compare_options):
+    from concurrent.futures import ThreadPoolExecutor
+
+    # each rank compares its round-robin share of the pairs, then the failed
+    # pairs and array errors are reduced so every rank returns the same verdict
+    if comm is None:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+
+    rank_result = ComparisonResult(None, None, tolerance)
+    rank_pairs = file_pairs[comm.rank::comm.size]
+    prefetcher = ThreadPoolExecutor(max_workers = 1)
+    error = None
+    try:
+        for i, file_pair in enumerate(rank_pairs):
+            # warm the page cache for the next pair while this one is compared
+            if i + 1 < len(rank_pairs):
+                prefetcher.submit(prefetch_pair, rank_pairs[i + 1])
+
+            file_pair, passed, log, pair_result = _compare_file_pair(file_pair, tolerance,
+                                                                     _serial_arrays(compare_options))
+            if pair_result is not None:
+                rank_result.merge(pair_result)
+            if not passed:
+                rank_result.failed_pairs.append(file_pair)
+                print("FAILED on rank", comm.rank, ":", file_pair[0], "vs", file_pair[1], "\n", log)
+    except Exception as e:
+        error = e
+    finally:
+        prefetcher.shutdown(cancel_futures = True)
+
+    result = ComparisonResult(None, None, tolerance)
+    for other in _gather_rank_results(comm, rank_result, error):
+        result.merge(other)
+
+    return result
+
+def compare_directories(first_dir, second_dir, pattern = "*", tolerance = 1e-12,
+                        nprocs = None, comm = None, **compare_options):
+    pairs, only_in_first, only_in_second = pair_directory_files(first_dir, second_dir, pattern)
+
+    if only_in_first or only_in_second:
+        print("Only in directory 1:", only_in_first, "\n", "Only in directory 2:", only_in_second)
+        raise ValueError("Fidelity test failed: Mismatched file names in directories")
+
+    if not pairs:
+        raise ValueError("Fidelity test failed: No matching files to compare")
+
+    result = ComparisonResult(first_dir, second_dir, tolerance)
+    if comm is not None:
+        result.merge(compare_file_pairs_mpi(pairs, tolerance, comm, **compare_options))
+    else:
+        result.merge(compare_file_pairs(pairs, tolerance, nprocs, **compare_options))
 
-                if curr_listname1 != curr_listname2:
-                    print("File 1:", curr_listname1, "\n", "File 2:", curr_listname2)
-                    raise ValueError("Fidelity test failed: Mismatched data list names")
+    failures = result.failed_pairs
+    if comm is None or comm.rank == 0:
+        result.print_summary()
+        print("Compared", len(pairs), "file pairs:", len(pairs) - len(failures), "passed,", len(failures), "failed")
 
-                curr_listname1 = subpath1 + "/" + curr_listname1
-                curr_listname2 = subpath2 + "/" + curr_listname2
+    if failures:
+        raise FidelityError("Fidelity test failed: Mismatched files in directories", result)
 
-                curr_datalist1 = np.array(list(f1[curr_listname1]))
-                curr_datalist2 = np.array(list(f2[curr_listname2]))
+    if comm is None or comm.rank == 0:
+        print("Directory Fidelity test completed successfully with tolerance", tolerance)
+    return result
 
-                if curr_datalist1.shape != curr_datalist2.shape:
-                    print("File 1,", curr_listname1, ":", curr_datalist1.shape, "\n", 
-                          "File 2,", curr_listname2, ":", curr_datalist2.shape)
-                    raise ValueError("Fidelity test failed: Mismatched data list size")
-                
-                if not np.allclose(curr_datalist1, curr_datalist2, atol = tolerance):
-                    print("Tolerance:", tolerance, "\n", "Data List:", curr_listname1)
-                    raise ValueError("Fidelity test failed: Mismatched data values with given tolerance")
+def snapshot_step(filename):
+    import os
+    import re
 
-    print("HDF5 Fidelity test completed successfully with tolerance", tolerance)
+    # step number of a snapshot, the last number in its name (fld-wave-eager-mpi-000-0010.pvtu -> 10)
+    numbers = re.findall(r"\d+", os.path.splitext(os.path.basename(filename))[0])
+    return int(numbers[-1]) if numbers else -1
+
+def snapshot_steps(filenames):
+    import os
+
+    # snapshot of every step, refusing file sets that do not hold one snapshot per step,
+    # such as the .vtu pieces next to their .pvtu or several files written at one step
+    pieces = set()
+    for filename in filenames:
+        if filename.endswith(".pvtu"):
+            pieces.update(os.path.abspath(piece) for piece in PvtuReader(filename).pieces)
+
+    steps = {}
+    for filename in filenames:
+        if os.path.abspath(filename) in pieces:
+            print("File:", filename)
+            raise ValueError("Snapshot is a piece of a .pvtu snapshot, select snapshots with a pattern")
+
+        step = snapshot_step(filename)
+        if step in steps:
+            print("File 1:", steps[step], "\n", "File 2:", filename)
+            raise ValueError("Two snapshots of step %d, select snapshots with a pattern" % step)
+        steps[step] = filename
+    return steps
+
+def step_summary(step, filename, passed, step_result):
+    # entry of an error growth curve for one snapshot
+    errors = {} if step_result is None else step_result.errors
+    return {
+        "step": step,
+        "file": filename,
+        "passed": passed,
+        "max_abs_err": float(np.max([abs_err for abs_err, _ in errors.values()])) if errors else None,
+        "max_rel_err": float(np.max([rel_err for _, rel_err in errors.values()])) if errors else None,
+        "fields": {name: abs_err for name, (abs_err, _) in errors.items()},
+        }
+
+def compare_time_series(first_dir, second_dir, pattern = "*", tolerance = 1e-12, fail_fast = False,
+                        **compare_options):
+    from concurrent.futures import ThreadPoolExecutor
+
+    pairs, only_in_first, only_in_second = pair_directory_files(first_dir, second_dir, pattern)
+
+    if only_in_first or only_in_second:
+        print("Only in directory 1:", only_in_first, "\n", "Only in directory 2:", only_in_second)
+        raise ValueError("Fidelity test failed: Mismatched file names in directories")
+
+    if not pairs:
+        raise ValueError("Fidelity test failed: No matching files to compare")
+
+    # snapshots are compared in step order, one at a time, recording how the error grows
+    snapshot_steps([pair[0] for pair in pairs])
+    pairs.sort(key = lambda pair: snapshot_step(pair[0]))
+
+    result = ComparisonResult(first_dir, second_dir, tolerance)
+    prefetcher = ThreadPoolExecutor(max_workers = 1)
+    try:
+        for i, file_pair in enumerate(pairs):
+            # warm the page cache for the next step while this one is compared
+            if i + 1 < len(pairs):
+                prefetcher.submit(prefetch_pair, pairs[i + 1])
+
+            file_pair, passed, log, pair_result = _compare_file_pair(file_pair, tolerance, compare_options)
+            step = snapshot_step(file_pair[0])
+
+            result.steps.append(step_summary(step, file_pair[1], passed, pair_result))
+            print("Step", step, ":", "max abs err", result.steps[-1]["max_abs_err"],
+                  "max rel err", result.steps[-1]["max_rel_err"])
+
+            if pair_result is not None:
+                result.merge(pair_result)
+            if not passed:
+                result.failed_pairs.append(file_pair)
+                print("FAILED:", file_pair[0], "vs", file_pair[1], "\n", log)
+
+                # later steps of a diverged run are not worth reading
+                if fail_fast:
+                    break
+    finally:
+        prefetcher.shutdown(cancel_futures = True)
+
+    result.print_summary()
+    print("Compared", len(result.steps), "of", len(pairs), "time steps:",
+          len(result.steps) - len(result.failed_pairs), "passed,", len(result.failed_pairs), "failed")
+
+    if result.failed_pairs:
+        print("First failing step:", snapshot_step(result.failed_pairs[0][0]))
+        raise FidelityError("Fidelity test failed: Mismatched time steps", result)
+
+    print("Time series Fidelity test completed successfully with tolerance", tolerance)
+    return result
+
+def simulation_array(values):
+    # host numpy array of simulation data: arrays, per-group containers such as dof arrays
+    # (flattened in group order), or object arrays of components (stacked as columns)
+    if isinstance(values, np.ndarray) and values.dtype == object:
+        return np.column_stack([simulation_array(component).reshape(-1) for component in values])
+    if hasattr(values, "__array__"):
+        return np.asarray(values)
+    return np.concatenate([simulation_array(group).reshape(-1) for group in values])
+
+class InSituComparator():
+    # compares arrays of a running simulation against stored reference output at matching
+    # steps, skipping the visualization file round trip, and keeps a running error log
+
+    def __init__(self, reference_dir, pattern = "*", tolerance = 1e-12, rtol = 0.0, log_file = None,
+                 comm = None, fail_fast = False):
+        import fnmatch
+        import os
+
+        # one reference file per step, pvtu files are split over the ranks of comm
+        self.reference_files = snapshot_steps(
+            [os.path.join(reference_dir, name) for name in sorted(os.listdir(reference_dir))
+             if fnmatch.fnmatch(name, pattern) and os.path.splitext(name)[1][1:] in ("vtu", "pvtu", "h5")])
+
+        self.tolerance = tolerance
+        self.rtol = rtol
+        self.log_file = log_file
+        self.comm = comm
+        self.fail_fast = fail_fast
+        self.result = ComparisonResult(reference_dir, "simulation", tolerance)
+
+    def read_reference(self, filename, names):
+        import os
+
+        file_type = os.path.splitext(filename)[1][1:]
+        if file_type == "h5":
+            file_reader = Hdf5Reader(filename)
+            try:
+                return {name: file_reader.read_specific_data(name)[()] for name in names
+                        if name in file_reader.file_obj}
+            finally:
+                file_reader.close()
+
+        if file_type == "pvtu" and self.comm is not None:
+            filename, file_type = PvtuReader(filename).pieces[self.comm.rank], "vtu"
+
+        arrays = dict(read_vtu_point_data(filename, file_type, streaming = True))
+        return {name: arrays[name]() for name in names if name in arrays}
+
+    def compare(self, step, fields):
+        import json
+
+        # steps without reference output are not compared
+        filename = self.reference_files.get(step)
+        if filename is None:
+            return None
+
+        step_result = ComparisonResult(filename, "simulation", self.tolerance)
+        error = None
+        try:
+            reference = self.read_reference(filename, fields)
+            for name, values in fields.items():
+                if name not in reference:
+                    print("File 1:", sorted(reference), "\n", "Simulation:", sorted(fields))
+                    raise ValueError("Fidelity test failed: Mismatched data array names")
+
+                values1 = reference[name]
+                values2 = simulation_array(values)
+                if values1.size != values2.size:
+                    print("File 1,", name, ":", values1.shape, "\n", "Simulation,", name, ":", values2.shape)
+                    raise ValueError("Fidelity test failed: Mismatched data array sizes")
+
+                step_result.add_field(name, values1.shape).update(values1, values2, self.tolerance, self.rtol)
+        except Exception as e:
+            if self.comm is None:
+                raise
+            error = e
+
+        # every rank compared its own piece
+        if self.comm is not None:
+            merged = ComparisonResult(filename, "simulation", self.tolerance)
+            for other in _gather_rank_results(self.comm, step_result, error):
+                merged.merge(other)
+            step_result = merged
+
+        self.result.merge(step_result)
+        self.result.steps.append(step_summary(step, filename, step_result.passed, step_result))
+
+        if self.comm is None or self.comm.rank == 0:
+            print("Step", step, ":", "max abs err", self.result.steps[-1]["max_abs_err"],
+                  "max rel err", self.result.steps[-1]["max_rel_err"])
+            if self.log_file is not None:
+                with open(self.log_file, "a") as f:
+                    f.write(json.dumps(self.result.steps[-1]) + "\n")
+
+        if self.fail_fast and not step_result.passed:
+            print("Tolerance:", self.tolerance, "\n", "DataArrays:", step_result.failed_fields)
+            raise FidelityError("Fidelity test failed: Mismatched simulation values with given tolerance",
+                                step_result)
+
+        return step_result
+
+def _run_job(request):
+    import os
+    import sys
+    import traceback
+
+    # one comparison job of the server, run in a forked process with output going to the client
+    exit_code = 0
+    try:
+        if "--mpi" in request["args"] or "--serve" in request["args"]:
+            print("--mpi and --serve jobs are not supported by the server", file = sys.stderr)
+            exit_code = 2
+        else:
+            os.chdir(request["cwd"])
+            main(request["args"])
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return exit_code
+
+def serve(socket_path, max_jobs = None):
+    import codecs
+    import importlib
+    import json
+    import os
+    import signal
+    import socketserver
+    import threading
+
+    # libraries are imported once here, every job runs in a process forked from this one
+    for module in ("h5py", "vtk"):
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+    jobs = threading.Semaphore(max_jobs or os.cpu_count() or 1)
+    fork_lock = threading.Lock()
+
+    class JobHandler(socketserver.StreamRequestHandler):
+        # request: one json line {"args": [...], "cwd": ...}; reply: json lines of
+        # {"output": ...} as the job prints, then {"exit_code": ...}
+        def handle(self):
+            def send(message):
+                self.wfile.write((json.dumps(message) + "\n").encode())
+                self.wfile.flush()
+
+            request = json.loads(self.rfile.readline())
+            with jobs:
+                # no other job's process may inherit the write end, or the output would never end
+                with fork_lock:
+                    read_fd, write_fd = os.pipe()
+                    pid = os.fork()
+                    if pid == 0:
+                        self.server.socket.close()
+                        os.close(read_fd)
+                        os.dup2(write_fd, 1)
+                        os.dup2(write_fd, 2)
+                        os._exit(_run_job(request))
+                    os.close(write_fd)
+
+                decoder = codecs.getincrementaldecoder("utf-8")(errors = "replace")
+                with os.fdopen(read_fd, "rb") as output:
+                    for chunk in iter(lambda: output.read1(2**16), b""):
+                        send({"output": decoder.decode(chunk)})
+                _, status = os.waitpid(pid, 0)
+                send({"exit_code": os.waitstatus_to_exitcode(status)})
+
+    class JobServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+    # a socket left behind by a server that did not shut down cleanly
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    # stopped with ctrl-c or SIGTERM, removing the socket
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    with JobServer(socket_path, JobHandler) as server:
+        print("Serving comparisons on", socket_path, flush = True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
 
 # run fidelity check
-if __name__ == "__main__":
+def main(argv = None):
     import argparse
     import os
 
     # read in file and comparison info from command line
     parser = argparse.ArgumentParser(description = 'Process files to perform fidelity check')
-    parser.add_argument('files', nargs = 2, type = str)
+    parser.add_argument('files', nargs = '*', type = str,
+                        help = 'two files, or two run output directories to compare file by file')
     parser.add_argument('--tolerance', type = float)
-    args = parser.parse_args();
+    parser.add_argument('--tolerance-policy', type = str, default = None,
+                        help = 'json spec of per-field atol/rtol, ulp distance and nan/inf handling')
+    parser.add_argument('--memory-limit', type = int, default = 256,
+                        help = 'memory budget in MiB for the hdf5 blocks of one file comparison, shared by the datasets compared at once')
+    parser.add_argument('--pattern', type = str, default = '*',
+                        help = 'file name pattern used to pair files in directory mode')
+    parser.add_argument('--nprocs', type = int, default = None,
+                        help = 'number of worker processes in directory and pvtu piece modes (default: all cores)')
+    parser.add_argument('--pvtu-pieces', action = 'store_true',
+                        help = 'compare .pvtu files piece by piece in parallel without assembling the global grid')
+    parser.add_argument('--mpi', action = 'store_true',
+                        help = 'distribute files or pvtu pieces over MPI ranks (launch with mpirun)')
+    parser.add_argument('--hash-first', action = 'store_true',
+                        help = 'skip the tolerance check for files and arrays with identical content digests')
+    parser.add_argument('--baseline-cache', type = str, default = None,
+                        help = 'directory of a persistent fingerprint cache for the first (reference) files')
+    parser.add_argument('--cache-size', type = int, default = 1024,
+                        help = 'size bound in MiB for cached reference data')
+    parser.add_argument('--cache-data', action = 'store_true',
+                        help = 'also cache memory-mapped copies of the reference arrays')
+    parser.add_argument('--report', type = str, default = None,
+                        help = 'write per-field error norms to a .json or .csv report')
+    parser.add_argument('--streaming', action = 'store_true',
+                        help = 'decode vtu arrays one at a time instead of loading whole grids')
+    parser.add_argument('--nthreads', type = int, default = None,
+                        help = 'threads comparing the arrays of one file (default: one per core, or 1 '
+                               'with --streaming or when files or pieces are compared in parallel)')
+    parser.add_argument('--reorder-points', action = 'store_true',
+                        help = 'match vtu/pvtu points by position, e.g. for runs with different rank counts')
+    parser.add_argument('--point-tolerance', type = float, default = 1e-10,
+                        help = 'per-coordinate distance within which --reorder-points treats two points as the same')
+    parser.add_argument('--time-series', action = 'store_true',
+                        help = 'compare two run output directories as a sequence of snapshots in step order')
+    parser.add_argument('--fail-fast', action = 'store_true',
+                        help = 'stop a time-series comparison at the first step that breaks tolerance')
+    parser.add_argument('--sample', type = float, default = None,
+                        help = 'quick check of this fraction of every vtu/hdf5 array (e.g. 0.01), '
+                               'compared in full only where it finds a problem')
+    parser.add_argument('--refine', action = 'store_true',
+                        help = 'always follow the --sample quick check with the full comparison')
+    parser.add_argument('--vtk', action = 'store_true',
+                        help = 'read vtu/pvtu files with vtk instead of the built-in reader')
+    parser.add_argument('--profile', type = str, default = None,
+                        help = 'write per-phase timings to this Chrome trace (.json) and print a summary')
+    parser.add_argument('--serve', type = str, default = None, metavar = 'SOCKET',
+                        help = 'keep running, serving comparisons from mirgecompare_client.py on this unix socket')
+    parser.add_argument('--max-jobs', type = int, default = None,
+                        help = 'comparisons the --serve server runs at the same time (default: all cores)')
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.serve, args.max_jobs)
+        return
+    if len(args.files) != 2:
+        parser.error("two files or directories to compare are required")
 
     first_file = args.files[0]  
     second_file = args.files[1] 
@@ -308,19 +2527,69 @@ if __name__ == "__main__":
     first_file = "examples/" + first_file
     second_file = "examples/" + second_file
 
-    file_split = os.path.splitext(first_file)[1]
-    file_type = file_split[1:]
-
     user_tolerance = 1e-12
     if args.tolerance:
         user_tolerance = args.tolerance
+    if args.tolerance_policy:
+        user_tolerance = TolerancePolicy.read(args.tolerance_policy, user_tolerance)
+
+    comm = None
+    if args.mpi:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+
+    if args.profile:
+        enable_profiling(args.profile)
+
+    cache = None
+    if args.baseline_cache:
+        cache = BaselineCache(args.baseline_cache, args.cache_size * 2**20, args.cache_data)
+
+    compare_options = dict(memory_limit = args.memory_limit * 2**20, hash_first = args.hash_first,
+                           cache = cache, streaming = args.streaming, use_vtk = args.vtk,
+                           nthreads = args.nthreads, reorder_points = args.reorder_points,
+                           point_tolerance = args.point_tolerance, sample = args.sample, refine = args.refine)
+
+    def run_comparison():
+        if args.time_series:
+            return compare_time_series(first_file, second_file, args.pattern, user_tolerance, args.fail_fast,
+                                       **compare_options)
+        elif os.path.isdir(first_file) and os.path.isdir(second_file):
+            return compare_directories(first_file, second_file, args.pattern, user_tolerance,
+                                       args.nprocs, comm, **compare_options)
+        elif comm is not None and not first_file.endswith(".pvtu"):
+            # a single non-partitioned file pair is compared on one rank
+            result = compare_file_pairs_mpi([(first_file, second_file)], user_tolerance,
+                                            comm, **compare_options)
+            if result.failed_pairs:
+                raise FidelityError("Fidelity test failed: Mismatched files", result)
+            if comm.rank == 0:
+                result.print_summary()
+                print("Fidelity test completed successfully with tolerance", user_tolerance)
+            return result
+        else:
+            return compare_files(first_file, second_file, user_tolerance, pvtu_pieces = args.pvtu_pieces,
+                                 nprocs = args.nprocs, comm = comm, **compare_options)
+
+    # the report is written for failed comparisons too
+    result = None
+    try:
+        result = run_comparison()
+    except FidelityError as e:
+        result = e.result
+        raise
+    finally:
+        if args.report and result is not None and (comm is None or comm.rank == 0):
+            result.write_report(args.report)
+
+        # every rank contributes its phases, rank 0 writes the merged trace
+        if args.profile:
+            events = _profiler.collect()
+            if comm is not None:
+                events = [event for rank_events in comm.gather(events, root = 0) or [] for event in rank_events]
+            if comm is None or comm.rank == 0:
+                Profiler.print_summary(events)
+                _profiler.write(events)
 
-    # use appropriate comparison function for file type
-    if file_type == "vtu" or file_type == "pvtu":
-        compare_files_vtu(first_file, second_file, file_type, user_tolerance)
-    elif file_type == "xmf":
-        compare_files_xdmf(first_file, second_file, user_tolerance)
-    elif file_type == "h5":
-        compare_files_hdf5(first_file, second_file, user_tolerance)
-    else:
-        raise TypeError("File type not supported")
+if __name__ == "__main__":
+    main()
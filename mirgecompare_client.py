@@ -0,0 +1,31 @@
+import json
+import os
+import socket
+import sys
+
+# thin client of a running `python mirgecompare.py --serve SOCKET`, taking the same arguments
+# as mirgecompare.py. only the standard library is imported, so a check costs no more than its i/o
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    socket_path = os.environ.get("MIRGECOMPARE_SOCKET", "mirgecompare.sock")
+    if args[:1] == ["--socket"]:
+        if len(args) < 2:
+            print("usage: mirgecompare_client.py [--socket SOCKET] MIRGECOMPARE_ARGS...", file = sys.stderr)
+            sys.exit(2)
+        socket_path = args[1]
+        args = args[2:]
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall((json.dumps({"args": args, "cwd": os.getcwd()}) + "\n").encode())
+
+        # print the output of the job as it arrives, and exit with its exit code
+        for line in connection.makefile("rb"):
+            message = json.loads(line)
+            if "exit_code" in message:
+                sys.exit(message["exit_code"])
+            sys.stdout.write(message["output"])
+            sys.stdout.flush()
+
+    print("Server closed the connection before the comparison finished", file = sys.stderr)
+    sys.exit(1)